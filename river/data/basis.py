@@ -0,0 +1,228 @@
+import numpy as np
+import h5py
+import torch
+import pickle
+import hashlib
+import os
+import tempfile
+
+'''
+Build SVD bases (Vh) from waveform shards on disk, e.g. the output of DataGeneratorBilbyFD.generate_waveforms_parallel
+without ipca/Vh. Waveforms are streamed in blocks, so memory is bounded by block_size * Nfreq + Nfreq * (Nbasis + oversampling).
+'''
+
+def iterate_waveform_blocks(filelist, block_size=1000, modes=['plus', 'cross'], normalize=True, max_samples=None):
+    '''
+    Yield complex waveforms [n, Nfreq] (amplitude * exp(1j*phase)) read block by block from waveform files.
+    normalize: scale each waveform to unit norm, so that all waveforms have the same importance in the basis.
+    '''
+    nread = 0
+    for filename in filelist:
+        with h5py.File(filename, 'r') as f:
+            Nsample = len(f[f'waveform_polarizations/{modes[0]}/amplitude'])
+            for i in range(0, Nsample, block_size):
+                if max_samples is not None and nread >= max_samples:
+                    return
+                j = min(i + block_size, Nsample)
+                if max_samples is not None:
+                    j = min(j, i + max_samples - nread)
+                for mode in modes:
+                    amplitude = f[f'waveform_polarizations/{mode}/amplitude'][i:j]
+                    phase = f[f'waveform_polarizations/{mode}/phase'][i:j]
+                    h = amplitude * np.exp(1j * phase)
+                    if normalize:
+                        norm = np.linalg.norm(h, axis=-1, keepdims=True)
+                        h = h / np.where(norm > 0, norm, 1)
+                    yield h
+                nread += j - i
+
+def get_waveform_length(filelist, mode='plus'):
+    with h5py.File(filelist[0], 'r') as f:
+        return f[f'waveform_polarizations/{mode}/amplitude'].shape[-1]
+
+def randomized_svd_from_files(filelist, Nbasis, oversampling=10, n_power_iter=3, block_size=1000, seed=None, **kwargs):
+    '''
+    Truncated SVD of the waveform matrix A [Nwaveform, Nfreq] (Halko et al. 2011), A is never held in memory.
+
+    The row space is found by power iterations Q <- orth(A^H A Q) starting from a random Q [Nfreq, Nbasis+oversampling],
+    each iteration is one pass over the files. A last pass computes (AQ)^H (AQ), whose eigen decomposition gives the singular values
+    and the right singular vectors Q U.
+
+    Returns Vh [Nbasis, Nfreq] and the singular values [Nbasis]. kwargs are passed to iterate_waveform_blocks.
+    '''
+    Nfreq = get_waveform_length(filelist)
+    nsketch = min(Nbasis + oversampling, Nfreq)
+    rng = np.random.default_rng(seed)
+    Q = rng.normal(size=(Nfreq, nsketch)) + 1j * rng.normal(size=(Nfreq, nsketch))
+    Q, _ = np.linalg.qr(Q)
+
+    for i_iter in range(n_power_iter):
+        Y = np.zeros((Nfreq, nsketch), dtype=complex)
+        for h in iterate_waveform_blocks(filelist, block_size=block_size, **kwargs):
+            Y += h.T.conj() @ (h @ Q)
+        Q, _ = np.linalg.qr(Y)
+        print(f"Power iteration {i_iter+1}/{n_power_iter} done.")
+
+    gram = np.zeros((nsketch, nsketch), dtype=complex)
+    for h in iterate_waveform_blocks(filelist, block_size=block_size, **kwargs):
+        hQ = h @ Q
+        gram += hQ.T.conj() @ hQ
+    eigenvalues, U = np.linalg.eigh(gram)
+    order = np.argsort(eigenvalues)[::-1][:Nbasis]
+    singular_values = np.clip(eigenvalues[order], 0, None)**0.5
+    Vh = (Q @ U[:, order]).T.conj()
+
+    return Vh, singular_values
+
+def compute_basis_mismatch(filelist, Vh, Nbasis_list=None, block_size=1000, max_samples=None):
+    '''
+    Reconstruction mismatch 1 - |h V_n| / |h| of (normalized) waveforms projected on the first n basis vectors, for n in Nbasis_list.
+    Returns a dict with Nbasis, mean, median and max mismatch.
+    '''
+    if Nbasis_list is None:
+        Nbasis_list = np.arange(1, len(Vh)+1)
+    Nbasis_list = np.asarray(Nbasis_list)
+    V = np.asarray(Vh).T.conj()
+    mismatches = []
+    for h in iterate_waveform_blocks(filelist, block_size=block_size, normalize=True, max_samples=max_samples):
+        projected_norm_square = np.cumsum(np.abs(h @ V)**2, axis=-1)[:, Nbasis_list-1]
+        mismatches.append(1 - np.clip(projected_norm_square, 0, 1)**0.5)
+    mismatches = np.concatenate(mismatches)
+
+    return {'Nbasis': Nbasis_list, 'mean': np.mean(mismatches, axis=0), 'median': np.median(mismatches, axis=0),
+            'max': np.max(mismatches, axis=0)}
+
+def save_basis(Vh, filename, dtype=np.complex64):
+    '''
+    Save Vh as .npy, which can be memory-mapped by load_basis.
+    '''
+    if not filename.endswith('.npy'):
+        raise ValueError("Basis file should end with .npy!")
+    np.save(filename, np.asarray(Vh, dtype=dtype))
+    print(f"Basis saved to {filename}")
+
+def load_basis(filename, Nbasis=None, mmap=True):
+    Vh = np.load(filename, mmap_mode='r' if mmap else None)
+    if Nbasis is not None:
+        if len(Vh)<Nbasis:
+            raise ValueError(f'required Nbasis ({Nbasis}) > len(Vh) ({len(Vh)})!')
+        Vh = Vh[:Nbasis]
+    return Vh
+
+def build_basis(filelist, Nbasis, filename=None, validation_filelist=None, Nbasis_list=None, max_validation_samples=10000,
+                oversampling=10, n_power_iter=3, block_size=1000, seed=None, dtype=np.complex64):
+    '''
+    Compute a Vh of Nbasis vectors from filelist, report its mismatch on validation_filelist (default: filelist) and save it to filename (.npy).
+    '''
+    Vh, singular_values = randomized_svd_from_files(filelist, Nbasis, oversampling=oversampling, n_power_iter=n_power_iter,
+                                                    block_size=block_size, seed=seed)
+    if validation_filelist is None:
+        validation_filelist = filelist
+    if Nbasis_list is None:
+        Nbasis_list = np.unique(np.linspace(1, Nbasis, min(Nbasis, 20)).astype(int))
+    mismatch = compute_basis_mismatch(validation_filelist, Vh, Nbasis_list=Nbasis_list, block_size=block_size,
+                                      max_samples=max_validation_samples)
+    for n, mean, mmax in zip(mismatch['Nbasis'], mismatch['mean'], mismatch['max']):
+        print(f"Nbasis={n}: mean mismatch {mean:.3e}, max mismatch {mmax:.3e}")
+
+    if filename is not None:
+        save_basis(Vh, filename, dtype=dtype)
+
+    return Vh, singular_values, mismatch
+
+
+class BasisStore():
+    '''
+    V/Vh of one basis file shared by all datasets of a process, see get_basis_store.
+
+    Vh is memory-mapped from .npy and only the first Nbasis rows are read. A pickled Vh is converted to .npy once, in cache_dir 
+    (default: default_basis_dir(), in the temporary directory), and not kept in memory.
+    Tensors are kept per (Nbasis, device), so datasets asking for the same basis get the same tensor, and V is a view (Vh.T.conj()).
+    Whitened bases V * sqrt(noise_weights) are saved to cache_dir, keyed by a hash of the basis, noise weights (PSD, frequency weights)
+    and frequency grid, and kept in memory per key.
+    '''
+    def __init__(self, filename, cache_dir=None):
+        self.filename = filename
+        self.cache_dir = cache_dir
+        self.tensors = {}
+        if filename.endswith('.npy'):
+            self.npy_filename = filename
+        else:
+            npy_dir = default_basis_dir() if cache_dir is None else cache_dir
+            self.npy_filename = f"{npy_dir}/basis_{self.get_file_key(filename)}.npy"
+            if not os.path.exists(self.npy_filename):
+                with open(filename, 'rb') as f:
+                    Vh = pickle.load(f)
+                os.makedirs(npy_dir, exist_ok=True)
+                tmp_filename = self.npy_filename + f'.tmp{os.getpid()}.npy'
+                np.save(tmp_filename, np.asarray(Vh, dtype=np.complex64))
+                os.replace(tmp_filename, self.npy_filename)
+                print(f"Basis saved to {self.npy_filename}")
+                del Vh
+
+    def get_file_key(self, filename):
+        return hashlib.sha1(f"{os.path.abspath(filename)}:{os.path.getsize(filename)}:{os.path.getmtime(filename)}".encode()).hexdigest()[:16]
+
+    def get_Vh_array(self, Nbasis):
+        return load_basis(self.npy_filename, Nbasis)
+
+    def get_Vh(self, Nbasis, device='cpu'):
+        key = ('Vh', Nbasis, str(device))
+        if key not in self.tensors:
+            # only the first Nbasis rows are read from the memory map
+            Vh = np.array(self.get_Vh_array(Nbasis), dtype=np.complex64)
+            self.tensors[key] = torch.from_numpy(Vh).to(device)
+        return self.tensors[key]
+
+    def get_V(self, Nbasis, device='cpu'):
+        return self.get_Vh(Nbasis, device).T.conj()
+
+    def get_whitened_V(self, Nbasis, noise_weights_list, device='cpu', frequency_array=None):
+        '''
+        [Ndet, Nfreq, Nbasis] complex64 tensor, V of each detector scaled by sqrt(noise_weights) (e.g. weights/(psd*duration/4)).
+        '''
+        noise_weights_list = [np.asarray(noise_weights, dtype=np.float64) for noise_weights in noise_weights_list]
+        sha = hashlib.sha1()
+        sha.update(self.get_file_key(self.npy_filename).encode())
+        sha.update(str(Nbasis).encode())
+        for array in noise_weights_list + ([] if frequency_array is None else [np.asarray(frequency_array)]):
+            sha.update(array.tobytes())
+        key = sha.hexdigest()[:16]
+        if (key, str(device)) in self.tensors:
+            return self.tensors[(key, str(device))]
+
+        cache_path = None if self.cache_dir is None else f"{self.cache_dir}/whitened_{key}.npy"
+        if cache_path is not None and os.path.exists(cache_path):
+            whitened_V = np.load(cache_path, mmap_mode='r')
+            print(f"Loaded whitened basis from {cache_path}")
+        else:
+            V = np.asarray(self.get_Vh_array(Nbasis)).T.conj()
+            whitened_V = np.stack([(V * noise_weights[:, None]**0.5).astype(np.complex64) for noise_weights in noise_weights_list])
+            if cache_path is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                np.save(cache_path + '.tmp.npy', whitened_V)
+                os.replace(cache_path + '.tmp.npy', cache_path)
+                print(f"Whitened basis saved to {cache_path}")
+        self.tensors[(key, str(device))] = torch.from_numpy(np.array(whitened_V)).to(device)
+        return self.tensors[(key, str(device))]
+
+
+basis_stores = {}
+
+def default_basis_dir():
+    '''
+    Where pickled bases are converted to .npy if no cache_dir is given.
+    '''
+    return os.path.join(tempfile.gettempdir(), 'river_basis')
+
+def get_basis_store(filename, cache_dir=None):
+    '''
+    The BasisStore of filename in this process, made on first call.
+    '''
+    key = os.path.abspath(filename)
+    if key not in basis_stores:
+        basis_stores[key] = BasisStore(filename, cache_dir=cache_dir)
+    elif cache_dir is not None and basis_stores[key].cache_dir is None:
+        basis_stores[key].cache_dir = cache_dir
+    return basis_stores[key]
+
@@ -2,9 +2,15 @@ import numpy as np
 import bilby
 import spiir.io
 #import utils as datautils
-from .utils import load_dict_from_hdf5, save_dict_to_hdf5, generate_random_distance
+from .utils import load_dict_from_hdf5, save_dict_to_hdf5, generate_random_distance, load_manifest, save_manifest, get_multibanded_frequency_array
+from .detector import get_detector_geometry, compute_detector_factors_vectorized, antenna_response_vectorized
+from .storage import GrowableArray, MemoryBudget, HDF5StreamWriter
+from .basis import load_basis
 import sealgw.simulation as sealsim
 import pickle
+import os
+from scipy.interpolate import CubicSpline
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 class DataGeneratorBilbyFD:
@@ -25,8 +31,27 @@ class DataGeneratorBilbyFD:
             snr_threshold = 8,
             ipca=None,
             Vh=None,
+            seed=None,
+            storage_dtype='float64',
+            memory_budget=None,
+            spill_dir=None,
+            multibanding=False,
+            mb_chirp_mass_min=0.8,
+            mb_safety=4,
+            mb_time_margin=1,
+            svd_storage='ampphase',
             **kwargs):
 
+        # keep the arguments so that workers can build their own generator
+        self.generator_kwargs = dict(source_type=source_type, detector_names=detector_names, duration=duration,
+            f_low=f_low, f_ref=f_ref, sampling_frequency=sampling_frequency, waveform_approximant=waveform_approximant,
+            parameter_names=parameter_names, frequency_domain_source_model=frequency_domain_source_model,
+            f_high=f_high, PSD_type=PSD_type, custom_psd_path=custom_psd_path, use_sealgw_detector=use_sealgw_detector,
+            snr_threshold=snr_threshold, ipca=ipca, Vh=Vh, storage_dtype=storage_dtype, memory_budget=memory_budget,
+            spill_dir=spill_dir, multibanding=multibanding, mb_chirp_mass_min=mb_chirp_mass_min, mb_safety=mb_safety,
+            mb_time_margin=mb_time_margin, svd_storage=svd_storage, **kwargs)
+        self.rng = np.random.default_rng(seed)
+
         # set properties
         self.source_type = source_type
         self.detector_names = detector_names
@@ -45,6 +70,12 @@ class DataGeneratorBilbyFD:
         self.whitened = False
         self.numpyed = False
 
+        # storage of generated data and waveforms. storage_dtype='float32' halves the memory (strains are stored as complex64),
+        # arrays are moved to disk (spill_dir) once they take more than memory_budget bytes in total
+        self.real_dtype = np.dtype(storage_dtype)
+        self.complex_dtype = np.result_type(self.real_dtype, np.complex64)
+        self.memory_budget = MemoryBudget(memory_budget, spill_dir)
+
         # set ifos
         if use_sealgw_detector:
             self.ifos = sealsim.sealinterferometers.SealInterferometerList(detector_names)
@@ -61,6 +92,21 @@ class DataGeneratorBilbyFD:
         self.frequency_mask = det.frequency_mask
         self.frequency_array = det.frequency_array
         self.frequency_array_masked = det.frequency_array[det.frequency_mask]
+        # data (strains, PSDs) always live on the uniform masked grid
+        self.data_frequency_array = self.frequency_array_masked
+
+        # waveforms are generated, stored and projected on frequency_array_masked, which is multibanded if multibanding=True. 
+        # frequency_weights: number of uniform bins each point stands for, used in noise weighted inner products
+        self.multibanding = multibanding
+        if multibanding:
+            self.frequency_array_masked, self.frequency_weights = get_multibanded_frequency_array(self.f_low, self.f_high, duration,
+                mb_chirp_mass_min, safety=mb_safety, time_margin=mb_time_margin)
+            self.waveform_frequency_mask = np.ones(len(self.frequency_array_masked), dtype=bool)
+            print(f"Multibanding: {len(self.frequency_array_masked)} frequencies instead of {len(self.data_frequency_array)}.")
+        else:
+            self.frequency_weights = np.ones(len(self.frequency_array_masked))
+            self.waveform_frequency_mask = self.frequency_mask
+        self.frequency_index_masked = np.round(self.frequency_array_masked * duration).astype(int)
 
         # set waveform
         self.waveform_arguments = dict(waveform_approximant=waveform_approximant,
@@ -82,6 +128,21 @@ class DataGeneratorBilbyFD:
             frequency_domain_source_model=frequency_domain_source_model,
             waveform_arguments=self.waveform_arguments)
 
+        # waveforms to be stored are evaluated at the multibanded frequencies directly
+        if multibanding:
+            if source_type == 'BNS' and frequency_domain_source_model == bilby.gw.source.lal_binary_neutron_star:
+                sequence_source_model = bilby.gw.source.binary_neutron_star_frequency_sequence
+            elif source_type == 'BBH' and frequency_domain_source_model == bilby.gw.source.lal_binary_black_hole:
+                sequence_source_model = bilby.gw.source.binary_black_hole_frequency_sequence
+            else:
+                raise Exception("Multibanding is only supported for default BNS and BBH source models!")
+            self.bank_waveform_generator = bilby.gw.WaveformGenerator(
+                duration=duration, sampling_frequency=sampling_frequency,
+                frequency_domain_source_model=sequence_source_model,
+                waveform_arguments=dict(self.waveform_arguments, frequencies=self.frequency_array_masked))
+        else:
+            self.bank_waveform_generator = self.waveform_generator
+
         # set PSD
         self.PSD_type = PSD_type
         self.custom_psd_path = custom_psd_path
@@ -117,7 +178,6 @@ class DataGeneratorBilbyFD:
         self.initialize_data()
 
         # set precalculated waveforms
-        self.initialize_waveforms()
         if type(ipca) == str:
             with open(ipca, 'rb') as f:
                 model = pickle.load(f)
@@ -126,8 +186,11 @@ class DataGeneratorBilbyFD:
             self.ipca = ipca
 
         if type(Vh) == str:
-            with open(Vh, 'rb') as f:
-                self.Vh = pickle.load(f)
+            if Vh.endswith('.npy'):
+                self.Vh = load_basis(Vh)
+            else:
+                with open(Vh, 'rb') as f:
+                    self.Vh = pickle.load(f)
         else:
             self.Vh = Vh
         if self.Vh is not None:
@@ -136,19 +199,33 @@ class DataGeneratorBilbyFD:
         if (self.Vh is not None) and (self.ipca is not None):
             raise ValueError("Got both IPCA and Vh!")
 
+        # svd_storage='complex' stores SVD coefficients as complex64 'coefficients' instead of 'amplitude' and 'phase'
+        if svd_storage not in ['ampphase', 'complex']:
+            raise ValueError(f"Unknown svd_storage {svd_storage}!")
+        if svd_storage == 'complex' and self.Vh is None:
+            raise ValueError("svd_storage='complex' requires Vh!")
+        self.svd_storage = svd_storage
+        self.waveform_parts = ['coefficients'] if svd_storage == 'complex' else ['amplitude', 'phase']
+        self.initialize_waveforms()
+
+    def new_storage(self, dtype):
+        return GrowableArray(dtype=dtype, budget=self.memory_budget)
+
     def initialize_data(self):
+        if hasattr(self, 'data'):
+            self.release_storage(self.data)
         self.data = {}
-        self.data['farray'] = self.frequency_array_masked
+        self.data['farray'] = self.data_frequency_array
         self.data['strains'] = {}
         self.data['PSDs'] = {}
         self.data['injection_parameters'] = {}
         self.data['SNRs'] = {}
         for detname in self.detector_names:
-            self.data['strains'][detname] = []
-            self.data['PSDs'][detname] = []
-            self.data['SNRs'][detname] = []
+            self.data['strains'][detname] = self.new_storage(self.complex_dtype)
+            self.data['PSDs'][detname] = self.new_storage(self.real_dtype)
+            self.data['SNRs'][detname] = self.new_storage(np.float64)
         for paraname in self.parameter_names:
-            self.data['injection_parameters'][paraname] = []
+            self.data['injection_parameters'][paraname] = self.new_storage(np.float64)
         self.data['Nsample'] = [0]
         self.Nsample=0
 
@@ -164,6 +241,20 @@ class DataGeneratorBilbyFD:
         self.Nsample+=1
         self.data['Nsample'][0] += 1
 
+    def update_data_batch(self, injection_parameters, strains, PSDs, SNRs):
+        '''
+        Batch version of update_data. injection_parameters: dict of arrays, strains/PSDs/SNRs: dict of [N, ...] arrays keyed by detector names.
+        '''
+        N = len(SNRs[self.detector_names[0]])
+        for detname in self.detector_names:
+            self.data['strains'][detname].extend(strains[detname])
+            self.data['PSDs'][detname].extend(PSDs[detname])
+            self.data['SNRs'][detname].extend(SNRs[detname])
+        for paraname in self.parameter_names:
+            self.data['injection_parameters'][paraname].extend(injection_parameters[paraname])
+        self.Nsample += N
+        self.data['Nsample'][0] += N
+
     def get_injected_snr(self):
         netsnr = 0
         for key, data in self.ifos.meta_data.items():
@@ -196,7 +287,11 @@ class DataGeneratorBilbyFD:
         else:
             print(f'SNR={netsnr}<{self.snr_threshold}, this injection is not recorded.')
 
-    def inject_signals(self, injection_parameters_all, Ninj, Nneeded=None):
+    def inject_signals(self, injection_parameters_all, Ninj, Nneeded=None, filename=None, write_every=100):
+        '''
+        If filename is given, data are appended to it every write_every injections and cleared from memory. 
+        Calling again with the same file continues after the last written injection.
+        '''
         if Nneeded is None:
             Nneeded = Ninj
             print("Nneeded not set. Actual number of injection may be less than Ninjection due to SNR threshold. ")
@@ -205,7 +300,9 @@ class DataGeneratorBilbyFD:
         else:
             pass
 
-        for i_inj in range(Ninj):
+        writer, i_start = self.open_data_writer(filename)
+        i_done = i_start
+        for i_inj in range(i_start, Ninj):
             if self.Nsample >= Nneeded:
                 break 
             print(f"Injecting {i_inj}-th signal, {round(100*i_inj/Ninj,2)}% done")
@@ -213,10 +310,227 @@ class DataGeneratorBilbyFD:
             for paraname in self.parameter_names:
                 injection_parameters[paraname] = injection_parameters_all[paraname][i_inj]
             self.inject_one_signal(injection_parameters)
+            i_done = i_inj + 1
+            if writer is not None and i_done % write_every == 0:
+                self.flush_data(writer, i_done)
+        self.close_data_writer(writer, i_done)
 
         if self.Nsample < Nneeded:
             print(f"Actual number of injection ({self.Nsample}) is less than Ninjection due to SNR threshold. ")
 
+    def open_data_writer(self, filename):
+        '''
+        Return a HDF5StreamWriter (None if filename is None) and the number of injections already done in it.
+        '''
+        if filename is None:
+            return None, 0
+        writer = HDF5StreamWriter(filename)
+        self.Nsample += writer.nrows
+        return writer, int(writer.attrs.get('Ninjected', 0))
+
+    def flush_data(self, writer, Ninjected):
+        '''
+        Append data in memory to writer and clear them, Ninjected is recorded to resume from.
+        '''
+        writer.append({key: self.data[key] for key in ['strains', 'PSDs', 'SNRs', 'injection_parameters']})
+        writer.write({'farray': self.data['farray'], 'Nsample': np.array([writer.nrows])})
+        writer.attrs['Ninjected'] = Ninjected
+        writer.flush()
+        self.release_storage(self.data)
+        self.data['Nsample'][0] = 0
+
+    def close_data_writer(self, writer, Ninjected):
+        if writer is not None:
+            self.flush_data(writer, Ninjected)
+            writer.close()
+            print(f"File saved to {writer.filename}")
+
+    def inject_polarizations_batch(self, injection_parameters, injection_polarizations):
+        '''
+        Vectorized, bilby-free version of ifos.inject_signal for N signals at once. 
+
+        injection_parameters: dict of [N] arrays
+        injection_polarizations: {'plus': [N, Nfreq_masked], 'cross': [N, Nfreq_masked]} on the uniform grid, already scaled by distance.
+
+        Noise is drawn from self.rng and coloured by the PSD in the same way as bilby's get_noise_realisation, 
+        the signal is projected and time shifted as in Interferometer.get_detector_response, 
+        so the output follows the same distribution as the per-sample bilby path. 
+        Returns masked strains, PSDs and matched filter SNRs (dicts of arrays keyed by detector names) and the network SNRs.
+        '''
+        N = len(injection_parameters['geocent_time'])
+        detector_tensors, vertices = get_detector_geometry(self.ifos)
+        fp, fc, time_delay = compute_detector_factors_vectorized(detector_tensors, vertices,
+                injection_parameters['ra'], injection_parameters['dec'], injection_parameters['geocent_time'], injection_parameters['psi'])
+        # same start time as inject_one_signal
+        start_time = injection_parameters['geocent_time'] - self.duration + 1
+        dt_geocent = injection_parameters['geocent_time'] - start_time
+
+        strains = {}
+        PSDs = {}
+        SNRs = {}
+        netsnr_square = np.zeros(N)
+        for i, det in enumerate(self.ifos):
+            detname = det.name
+            frequencies = det.frequency_array[det.frequency_mask]
+            psd = det.power_spectral_density_array[det.frequency_mask]
+
+            signal = fp[:,i:i+1] * injection_polarizations['plus'] + fc[:,i:i+1] * injection_polarizations['cross']
+            dt = dt_geocent + time_delay[:,i]
+            signal = signal * np.exp(-1j * 2 * np.pi * dt[:,None] * frequencies[None,:])
+
+            if self.PSD_type in ['bilby_default', 'custom']:
+                norm = 0.5 * self.duration**0.5
+                white_noise = self.rng.normal(0, norm, (N, len(frequencies))) + 1j * self.rng.normal(0, norm, (N, len(frequencies)))
+                with np.errstate(invalid="ignore"):
+                    noise = psd**0.5 * white_noise
+                noise[:, ~np.isfinite(psd)] = 0
+            elif self.PSD_type == 'zero_noise':
+                noise = np.zeros((N, len(frequencies)), dtype=complex)
+            else:
+                raise Exception("Under development!")
+            strain = signal + noise
+
+            # noise weighted inner products, 4/T sum(a* b / S)
+            optimal_snr_squared = np.real(np.sum(np.conj(signal) * signal / psd, axis=-1)) * 4 / self.duration
+            matched_filter_snr = np.sum(np.conj(signal) * strain / psd, axis=-1) * 4 / self.duration / optimal_snr_squared**0.5
+            netsnr_square += np.abs(matched_filter_snr)**2
+
+            strains[detname] = strain
+            PSDs[detname] = np.tile(psd, (N, 1))
+            SNRs[detname] = np.abs(matched_filter_snr)
+
+        return strains, PSDs, SNRs, netsnr_square**0.5
+
+    def _inject_batches(self, get_injection_batch, Ninj, Nneeded, batch_size, filename=None, write_every=1000, candidates=None):
+        if Nneeded is None:
+            Nneeded = Ninj
+            print("Nneeded not set. Actual number of injection may be less than Ninjection due to SNR threshold. ")
+        elif Nneeded>Ninj:
+            raise ValueError("Needed > Ninj!")
+        if candidates is None:
+            candidates = np.arange(Ninj)
+
+        writer, i_first = self.open_data_writer(filename)
+        candidates = candidates[candidates >= i_first]
+        i_done = i_first
+        for i_start in range(0, len(candidates), batch_size):
+            if self.Nsample >= Nneeded:
+                break
+            index = candidates[i_start:i_start+batch_size]
+            print(f"Injecting {index[0]}-{index[-1]}-th signals, {round(100*index[0]/Ninj,2)}% done")
+            injection_parameters, injection_polarizations = get_injection_batch(index)
+            strains, PSDs, SNRs, netsnr = self.inject_polarizations_batch(injection_parameters, injection_polarizations)
+
+            selected = np.where(netsnr >= self.snr_threshold)[0][:Nneeded-self.Nsample]
+            self.update_data_batch({paraname: injection_parameters[paraname][selected] for paraname in self.parameter_names},
+                                   {detname: strains[detname][selected] for detname in self.detector_names},
+                                   {detname: PSDs[detname][selected] for detname in self.detector_names},
+                                   {detname: SNRs[detname][selected] for detname in self.detector_names})
+            i_done = index[-1] + 1
+            if writer is not None and self.data['Nsample'][0] >= write_every:
+                self.flush_data(writer, i_done)
+        self.close_data_writer(writer, i_done)
+
+        if self.Nsample < Nneeded:
+            print(f"Actual number of injection ({self.Nsample}) is less than Ninjection due to SNR threshold. ")
+
+    def inject_signals_batch(self, injection_parameters_all, Ninj, Nneeded=None, batch_size=1000, filename=None, write_every=1000):
+        '''
+        Batch version of inject_signals. Waveforms are still generated one by one by LAL, 
+        noise, projection, time shifts and SNRs are computed for batch_size samples at once.
+        filename and write_every: see inject_signals.
+        '''
+        def get_injection_batch(index):
+            injection_parameters = {paraname: np.asarray(injection_parameters_all[paraname])[index] for paraname in self.parameter_names}
+            injection_polarizations = {'plus': [], 'cross': []}
+            for i in index:
+                wf = self.waveform_generator.frequency_domain_strain(self.get_one_injection_parameters(i, injection_parameters_all))
+                for mode in ['plus', 'cross']:
+                    injection_polarizations[mode].append(wf[mode][self.frequency_mask])
+            injection_polarizations = {mode: np.array(pp) for mode, pp in injection_polarizations.items()}
+            return injection_parameters, injection_polarizations
+
+        self._inject_batches(get_injection_batch, Ninj, Nneeded, batch_size, filename=filename, write_every=write_every)
+
+    def inject_signals_from_waveforms_batch(self, injection_parameters_all, Ninj, Nneeded=None, batch_size=1000, filename=None, write_every=1000,
+                                            preselect=True, snr_margin=3):
+        '''
+        Batch version of inject_signals_from_waveforms, no bilby calls are involved.
+        injection_parameters_all: injection para dict that contains t_c, ra, dec, psi, d_L. Others are not used.
+        preselect: only inject candidates with estimated optimal SNR >= snr_threshold - snr_margin, see select_candidates.
+        filename and write_every: see inject_signals.
+        '''
+        def get_injection_batch(index):
+            injection_parameters = {paraname: np.asarray(injection_parameters_all[paraname])[index] for paraname in self.parameter_names}
+            injection_polarizations = self.reconstruct_waveforms_batch(self.waveforms['waveform_polarizations'], index,
+                                                                       dL=injection_parameters['luminosity_distance'])
+            injection_polarizations = {mode: self.interpolate_to_uniform(pp) for mode, pp in injection_polarizations.items()}
+            return injection_parameters, injection_polarizations
+
+        candidates = None
+        if preselect:
+            candidates = self.select_candidates(injection_parameters_all, np.arange(Ninj), snr_margin=snr_margin)
+        self._inject_batches(get_injection_batch, Ninj, Nneeded, batch_size, filename=filename, write_every=write_every, candidates=candidates)
+
+    def get_waveform_inner_products(self, waveform_list, index):
+        '''
+        Noise weighted inner products <h+,h+>, <hx,hx> and Re<h+,hx> of waveforms at 1 Mpc, each [N, ndet].
+        waveform_list: e.g. self.waveforms['waveform_polarizations']. 
+        When Vh is set, they are computed from the SVD coefficients directly with Vh W Vh^H, W being the inverse PSD weights.
+        '''
+        index = np.atleast_1d(index)
+        if self.Vh is not None:
+            coefficients = {mode: self.get_svd_coefficients(waveform_list[mode], index) for mode in ['plus', 'cross']}
+        else:
+            polarizations = self.reconstruct_waveforms_batch(waveform_list, index, dL=1)
+
+        inner_products = {key: np.zeros((len(index), len(self.ifos))) for key in ['pp', 'cc', 'pc']}
+        for i, det in enumerate(self.ifos):
+            weights = 4 / self.duration * self.frequency_weights / self.get_psd_masked(det)
+            if self.Vh is not None:
+                gram = (self.Vh * weights) @ self.Vh.T.conj()
+                gram_hp = coefficients['plus'] @ gram
+                gram_hc = coefficients['cross'] @ gram
+                hp, hc = coefficients['plus'], coefficients['cross']
+                inner_products['pp'][:,i] = np.real(np.sum(np.conj(hp) * gram_hp, axis=-1))
+                inner_products['cc'][:,i] = np.real(np.sum(np.conj(hc) * gram_hc, axis=-1))
+                inner_products['pc'][:,i] = np.real(np.sum(np.conj(hp) * gram_hc, axis=-1))
+            else:
+                hp, hc = polarizations['plus'], polarizations['cross']
+                inner_products['pp'][:,i] = np.sum(np.abs(hp)**2 * weights, axis=-1)
+                inner_products['cc'][:,i] = np.sum(np.abs(hc)**2 * weights, axis=-1)
+                inner_products['pc'][:,i] = np.real(np.sum(np.conj(hp) * hc * weights, axis=-1))
+
+        return inner_products
+
+    def estimate_optimal_snr(self, injection_parameters, inner_products):
+        '''
+        Optimal network SNRs of N candidates, without generating noise or injecting.
+        injection_parameters: dict of [N] arrays with ra, dec, psi, geocent_time and luminosity_distance
+        inner_products: from get_waveform_inner_products. 
+        rho^2 = sum_det (F+^2 <h+,h+> + Fx^2 <hx,hx> + 2 F+ Fx Re<h+,hx>) / d_L^2, time shifts do not change it.
+        '''
+        detector_tensors, _ = get_detector_geometry(self.ifos)
+        fp, fc = antenna_response_vectorized(detector_tensors, injection_parameters['ra'], injection_parameters['dec'],
+                                             injection_parameters['geocent_time'], injection_parameters['psi'])
+        snr_square = fp**2 * inner_products['pp'] + fc**2 * inner_products['cc'] + 2 * fp * fc * inner_products['pc']
+        return np.sum(snr_square, axis=-1)**0.5 / np.asarray(injection_parameters['luminosity_distance'])
+
+    def select_candidates(self, injection_parameters_all, index, snr_margin=3, waveform_list=None):
+        '''
+        Return the candidates in index whose estimated optimal SNR >= snr_threshold - snr_margin. 
+        The matched filter SNR scatters around the optimal SNR by ~N(0,1), so with snr_margin=3 the selection is practically unchanged.
+        '''
+        if waveform_list is None:
+            waveform_list = self.waveforms['waveform_polarizations']
+        index = np.asarray(index)
+        injection_parameters = {paraname: np.asarray(injection_parameters_all[paraname])[index] 
+                                for paraname in ['ra', 'dec', 'psi', 'geocent_time', 'luminosity_distance']}
+        optimal_snr = self.estimate_optimal_snr(injection_parameters, self.get_waveform_inner_products(waveform_list, index))
+        candidates = index[optimal_snr >= self.snr_threshold - snr_margin]
+        print(f"{len(candidates)}/{len(index)} candidates pass the estimated SNR cut.")
+        return candidates
+
     def get_data(self, i_data):
         if i_data>self.Nsample:
             raise ValueError(f"i_data ({i_data}) > Nsample ({self.Nsample})!")
@@ -242,28 +556,36 @@ class DataGeneratorBilbyFD:
     
     def load_data(self, filename):
         new_data = load_dict_from_hdf5(filename)
-        if (new_data['farray'] != self.frequency_array_masked).any():
+        if (new_data['farray'] != self.data_frequency_array).any():
             raise Exception("Frequency arrays do not match!")
         if set(list(self.data['injection_parameters'].keys())) != set(list(new_data['injection_parameters'].keys())):
             raise Exception(("Parameter names do not match!"))
         
         for detname in self.detector_names:
-            self.data['strains'][detname]+= new_data['strains'][detname]
-            self.data['PSDs'][detname]+= new_data['PSDs'][detname]
-            self.data['SNRs'][detname]+= new_data['SNRs'][detname]
+            self.data['strains'][detname].extend(new_data['strains'][detname])
+            self.data['PSDs'][detname].extend(new_data['PSDs'][detname])
+            self.data['SNRs'][detname].extend(new_data['SNRs'][detname])
         for paraname in self.parameter_names:
-            self.data['injection_parameters'][paraname]+= new_data['injection_parameters'][paraname]
+            self.data['injection_parameters'][paraname].extend(new_data['injection_parameters'][paraname])
 
         self.Nsample += new_data['Nsample'][0]
         self.data['Nsample'][0] += new_data['Nsample'][0]
     
     def numpy_starins(self):
+        # views of the storage, no copy
         for detname in self.detector_names:
-            self.data['strains'][detname] = np.array(self.data['strains'][detname])
-            self.data['PSDs'][detname] = np.array(self.data['PSDs'][detname])
-            self.data['SNRs'][detname] = np.array(self.data['SNRs'][detname])
+            self.data['strains'][detname] = np.asarray(self.data['strains'][detname])
+            self.data['PSDs'][detname] = np.asarray(self.data['PSDs'][detname])
+            self.data['SNRs'][detname] = np.asarray(self.data['SNRs'][detname])
         self.numpyed = True
 
+    def release_storage(self, dic):
+        for item in dic.values():
+            if isinstance(item, GrowableArray):
+                item.clear()
+            elif isinstance(item, dict):
+                self.release_storage(item)
+
     def scale_strains(self):
         assert self.whitened == False, 'Strain already whitened!'
         for detname in self.detector_names:
@@ -280,18 +602,21 @@ class DataGeneratorBilbyFD:
     #### to deal with large training set, we should generate waveforms and store them in disk
     #### when inject, read those waveforms and apply extrinsic parameters
     def initialize_waveforms(self):
+        if hasattr(self, 'waveforms'):
+            self.release_storage(self.waveforms)
         self.waveforms = {}
         #self.waveforms['farray'] = self.frequency_array_masked
         self.waveforms['waveform_polarizations'] = {}
         for mode in ['plus', 'cross']:
             self.waveforms['waveform_polarizations'][mode] = {}
-            for part in ['amplitude', 'phase']:
-                self.waveforms['waveform_polarizations'][mode][part] = []
+            for part in self.waveform_parts:
+                dtype = np.complex64 if part == 'coefficients' else self.real_dtype
+                self.waveforms['waveform_polarizations'][mode][part] = self.new_storage(dtype)
 
         self.waveforms['injection_parameters'] = {}
         for paraname in self.parameter_names:
             if paraname not in ['luminosity_distance', 'ra', 'dec', 'psi', 'geocent_time']:
-                self.waveforms['injection_parameters'][paraname] = []
+                self.waveforms['injection_parameters'][paraname] = self.new_storage(np.float64)
         self.Nwaveform = 0
         #self.waveforms['SNR_at_1Mpc'] = []
 
@@ -301,52 +626,167 @@ class DataGeneratorBilbyFD:
                 self.waveforms['injection_parameters'][paraname].append(injection_parameters[paraname])
 
         for mode in ['plus', 'cross']:
-            for part in ['amplitude', 'phase']:
+            for part in self.waveform_parts:
                 self.waveforms['waveform_polarizations'][mode][part].append(wave_dict[mode][part])
 
         self.Nwaveform += 1
 
-    def generate_one_waveform(self, injection_parameters):
+    def update_waveforms_batch(self, injection_parameters, wave_dict):
         '''
-        Generate a waveform with "intrisic" parameters. 
-        "Extrisic" parameters (t_c, ra, dec, psi, d_L) are not involved in waveform generation. They will be applied during injection. 
+        Batch version of update_waveforms. injection_parameters: dict of [N] arrays, wave_dict: output of process_waveform_block.
+        '''
+        for paraname in self.parameter_names:
+            if paraname not in ['luminosity_distance', 'ra', 'dec', 'psi', 'geocent_time']:
+                self.waveforms['injection_parameters'][paraname].extend(injection_parameters[paraname])
+
+        for mode in ['plus', 'cross']:
+            for part in self.waveform_parts:
+                self.waveforms['waveform_polarizations'][mode][part].extend(wave_dict[mode][part])
+
+        self.Nwaveform += len(wave_dict['plus'][self.waveform_parts[0]])
+
+    def process_waveform_block(self, polarizations):
+        '''
+        Mask, decompose and project a block of waveforms with matrix operations.
+        polarizations: {'plus': [N, Nfreq], 'cross': [N, Nfreq]}, output of waveform_generator stacked.
         '''
-        injection_parameters['luminosity_distance'] = 1 # fix distance as it scales amplitude 
-        wf = self.waveform_generator.frequency_domain_strain(injection_parameters)
         wf_masked = {}
-        for key, mode in wf.items():
-            h = mode[self.frequency_mask]
-            amp = np.abs(h) * 1e23
-            phase = np.unwrap(np.angle(h))
+        for key, mode in polarizations.items():
+            h = mode[:, self.waveform_frequency_mask]
             wf_masked[key] = {}
 
             if self.Vh is not None:
                 h_proj = h @ self.V
-                wf_masked[key]['amplitude'] = np.abs(h_proj) 
-                wf_masked[key]['phase'] = np.angle(h_proj)
+                if self.svd_storage == 'complex':
+                    wf_masked[key]['coefficients'] = h_proj.astype(np.complex64)
+                else:
+                    wf_masked[key]['amplitude'] = np.abs(h_proj) 
+                    wf_masked[key]['phase'] = np.angle(h_proj)
             elif self.ipca:
-                amp_proj = np.dot(amp, self.ipca[key]['amplitude'].components_.T)
-                phase_proj = np.dot(phase, self.ipca[key]['phase'].components_.T)
-                wf_masked[key]['amplitude'] = amp_proj
-                wf_masked[key]['phase'] = phase_proj
+                amp = np.abs(h) * 1e23
+                phase = np.unwrap(np.angle(h), axis=-1)
+                wf_masked[key]['amplitude'] = amp @ self.ipca[key]['amplitude'].components_.T
+                wf_masked[key]['phase'] = phase @ self.ipca[key]['phase'].components_.T
             else:
-                wf_masked[key]['amplitude'] = amp 
-                wf_masked[key]['phase'] = phase
+                wf_masked[key]['amplitude'] = np.abs(h) * 1e23
+                wf_masked[key]['phase'] = np.unwrap(np.angle(h), axis=-1)
+
+        return wf_masked
+
+    def generate_one_waveform(self, injection_parameters):
+        '''
+        Generate a waveform with "intrisic" parameters. 
+        "Extrisic" parameters (t_c, ra, dec, psi, d_L) are not involved in waveform generation. They will be applied during injection. 
+        '''
+        injection_parameters['luminosity_distance'] = 1 # fix distance as it scales amplitude 
+        wf = self.bank_waveform_generator.frequency_domain_strain(injection_parameters)
+        wf_masked = self.process_waveform_block({key: mode[None] for key, mode in wf.items()})
+        wf_masked = {key: {part: value[0] for part, value in mode.items()} for key, mode in wf_masked.items()}
 
         self.update_waveforms(injection_parameters, wf_masked)
 
-        
-        
+    def generate_waveform_block(self, injection_parameters_all, index):
+        '''
+        Generate waveforms of index. LAL is called one by one, post-processing is done for the whole block by process_waveform_block.
+        '''
+        polarizations = {'plus': [], 'cross': []}
+        for i in index:
+            injection_parameters = self.get_one_injection_parameters(i, injection_parameters_all)
+            injection_parameters['luminosity_distance'] = 1 # fix distance as it scales amplitude 
+            wf = self.bank_waveform_generator.frequency_domain_strain(injection_parameters)
+            for key in polarizations.keys():
+                polarizations[key].append(wf[key])
+        wf_masked = self.process_waveform_block({key: np.array(mode) for key, mode in polarizations.items()})
+
+        injection_parameters = {paraname: np.asarray(injection_parameters_all[paraname])[index] for paraname in self.parameter_names}
+        self.update_waveforms_batch(injection_parameters, wf_masked)
+
+    def generate_waveforms(self, injection_parameters_all, filename=None, write_every=100, block_size=64):
+        '''
+        Waveforms are generated in blocks of block_size, see generate_waveform_block.
+        If filename is given, waveforms are appended to it every write_every waveforms and cleared from memory. 
+        Calling again with the same file continues after the waveforms already in it.
+        '''
+        N = len(injection_parameters_all['chirp_mass'])
+        i_start = 0
+        writer = None
+        if filename is not None:
+            writer = HDF5StreamWriter(filename)
+            i_start = writer.nrows
+            if i_start:
+                print(f"{i_start} waveforms found in {filename}, continue from there.")
+        for i_block in range(i_start, N, block_size):
+            self.generate_waveform_block(injection_parameters_all, np.arange(i_block, min(i_block+block_size, N)))
+            if writer is not None and len(self.waveforms['waveform_polarizations']['plus'][self.waveform_parts[0]]) >= write_every:
+                self.flush_waveforms(writer)
+
+        if writer is not None:
+            self.flush_waveforms(writer)
+            writer.close()
+            print(f"File saved to {filename}")
+
+    def flush_waveforms(self, writer):
+        '''
+        Append waveforms in memory to writer and clear them.
+        '''
+        writer.append(self.waveforms)
+        writer.flush()
+        self.release_storage(self.waveforms)
 
-    def generate_waveforms(self, injection_parameters_all):
+    def generate_waveforms_parallel(self, injection_parameters_all, outdir, shard_size=1000, nproc=None, seed=None, filename_prefix='waveforms'):
+        '''
+        Generate waveforms in a process pool. 
+
+        injection_parameters_all is split into shards of shard_size samples. Each shard is generated by a worker with its own 
+        DataGeneratorBilbyFD and its own random stream (spawned from seed), and saved to {outdir}/{filename_prefix}_{ishard}.h5. 
+        {outdir}/manifest.json records finished shards, so calling this again with the same arguments after a crash only generates the missing ones.
+        '''
         N = len(injection_parameters_all['chirp_mass'])
-        for i in range(N):
-            injection_parameters = {}
-            for paraname in self.parameter_names:
-                injection_parameters[paraname] = injection_parameters_all[paraname][i]
+        nshard = int(np.ceil(N / shard_size))
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+
+        manifest_path = f"{outdir}/manifest.json"
+        manifest = load_manifest(manifest_path)
+        if manifest is None:
+            manifest = {'Nsample': N, 'shard_size': shard_size, 'seed': seed, 'shards': {}}
+        elif manifest['Nsample'] != N or manifest['shard_size'] != shard_size or manifest['seed'] != seed:
+            raise ValueError(f"{manifest_path} was made with different Nsample/shard_size/seed!")
+
+        seed_sequences = np.random.SeedSequence(seed).spawn(nshard)
+        tasks = {}
+        for ishard in range(nshard):
+            filename = f"{outdir}/{filename_prefix}_{ishard}.h5"
+            shard_info = manifest['shards'].get(str(ishard))
+            if shard_info is not None and shard_info['done'] and os.path.exists(filename):
+                continue
+            start = ishard * shard_size
+            end = min(start + shard_size, N)
+            injection_parameters_shard = {paraname: np.asarray(injection_parameters_all[paraname])[start:end] for paraname in self.parameter_names}
+            tasks[ishard] = (filename, start, end, injection_parameters_shard)
+        print(f"{nshard - len(tasks)}/{nshard} shards already finished, generating {len(tasks)} shards.")
+
+        failed = []
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            futures = {executor.submit(_generate_waveform_shard, self.generator_kwargs, task[3], task[0], seed_sequences[ishard]): ishard
+                       for ishard, task in tasks.items()}
+            for future in as_completed(futures):
+                ishard = futures[future]
+                filename, start, end, _ = tasks[ishard]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Shard {ishard} failed: {e}")
+                    failed.append(ishard)
+                    continue
+                manifest['shards'][str(ishard)] = {'filename': filename, 'start': start, 'end': end, 'done': True}
+                save_manifest(manifest, manifest_path)
+                print(f"Shard {ishard} saved to {filename}, {len(manifest['shards'])}/{nshard} done")
 
-            self.generate_one_waveform(injection_parameters)
-            
+        if failed:
+            raise Exception(f"Shards {sorted(failed)} failed, run again to resume.")
+
+        return [f"{outdir}/{filename_prefix}_{ishard}.h5" for ishard in range(nshard)]
     
     def reconstruct_waveforms(self, wave_dict, dL = 1):
         '''
@@ -354,7 +794,9 @@ class DataGeneratorBilbyFD:
         '''
         waveform_polarizations = {}
         for polarization, waveform_component in wave_dict.items():
-            if self.ipca:
+            if self.Vh is not None:
+                waveform_polarizations[polarization] = self.get_svd_coefficients(waveform_component, Ellipsis) @ self.Vh / dL
+            elif self.ipca:
                 ipca_A = self.ipca[polarization]['amplitude']
                 ipca_phi = self.ipca[polarization]['phase']
                 #A_reconstructed = np.dot(ipca_A.transform([waveform_component['amplitude']])[0], ipca_A.components_) / dL
@@ -366,7 +808,56 @@ class DataGeneratorBilbyFD:
                 waveform_polarizations[polarization] = waveform_component['amplitude'] / dL / 1e23 * np.exp(1j *  waveform_component['phase'])
 
         return waveform_polarizations
+
+    def get_svd_coefficients(self, waveform_component, index):
+        '''
+        Complex SVD coefficients of rows index, from either storage format.
+        '''
+        if 'coefficients' in waveform_component:
+            return np.asarray(waveform_component['coefficients'])[index]
+        amplitude = np.asarray(waveform_component['amplitude'])[index]
+        phase = np.asarray(waveform_component['phase'])[index]
+        return amplitude * np.exp(1j * phase)
+
+    def reconstruct_waveforms_batch(self, waveform_list, index, dL=1):
+        '''
+        Vectorized reconstruct_waveforms for rows index of waveform_list (e.g. self.waveforms['waveform_polarizations']).
+        dL: scalar or [N] array. Returns {'plus': [N, Nfreq_masked], 'cross': [N, Nfreq_masked]}.
+        '''
+        dL = np.atleast_1d(dL)[:,None]
+        waveform_polarizations = {}
+        for polarization in ['plus', 'cross']:
+            if self.Vh is not None:
+                waveform_polarizations[polarization] = self.get_svd_coefficients(waveform_list[polarization], index) @ self.Vh / dL
+                continue
+            amplitude = np.asarray(waveform_list[polarization]['amplitude'])[index]
+            phase = np.asarray(waveform_list[polarization]['phase'])[index]
+            if self.ipca:
+                ipca_A = self.ipca[polarization]['amplitude']
+                ipca_phi = self.ipca[polarization]['phase']
+                waveform_polarizations[polarization] = (amplitude @ ipca_A.components_) / dL / 1e23 * np.exp(1j * (phase @ ipca_phi.components_))
+            else:
+                waveform_polarizations[polarization] = amplitude / dL / 1e23 * np.exp(1j * phase)
+
+        return waveform_polarizations
     
+    def interpolate_to_uniform(self, h):
+        '''
+        Interpolate waveforms [..., Nfreq_masked] on the multibanded grid to the uniform grid (data_frequency_array).
+        Amplitude and unwrapped phase are interpolated with cubic splines. Nothing is done without multibanding.
+        '''
+        if not self.multibanding:
+            return h
+        amplitude = CubicSpline(self.frequency_array_masked, np.abs(h), axis=-1)(self.data_frequency_array)
+        phase = CubicSpline(self.frequency_array_masked, np.unwrap(np.angle(h), axis=-1), axis=-1)(self.data_frequency_array)
+        return np.clip(amplitude, 0, None) * np.exp(1j * phase)
+
+    def get_psd_masked(self, det):
+        '''
+        PSD of det on the waveform grid frequency_array_masked.
+        '''
+        return det.power_spectral_density_array[self.frequency_index_masked]
+
     def inject_one_signal_from_waveforms(self, injection_parameters, injection_polarizations_compressed):
         if self.PSD_type in ['bilby_default', 'custom']:
             self.ifos.set_strain_data_from_power_spectral_densities(
@@ -383,7 +874,8 @@ class DataGeneratorBilbyFD:
                                                              dL = injection_parameters['luminosity_distance'])
         # unmask waveforms
         for kk,pp in injection_polarizations.items():
-            append_zeros = np.zeros(len(self.frequency_array) - len(self.frequency_array_masked))
+            pp = self.interpolate_to_uniform(pp)
+            append_zeros = np.zeros(len(self.frequency_array) - len(self.data_frequency_array))
             injection_polarizations[kk] = np.append(append_zeros, pp)
         
         if self.use_sealgw_detector:
@@ -402,9 +894,10 @@ class DataGeneratorBilbyFD:
             return 0
     
 
-    def inject_signals_from_waveforms(self, injection_parameters_all, Ninj, Nneeded=None):
+    def inject_signals_from_waveforms(self, injection_parameters_all, Ninj, Nneeded=None, preselect=False, snr_margin=3):
         '''
         injection_parameters_all: injection para dict that contains t_c, ra, dec, psi, d_L. Others are not used.
+        preselect: skip candidates with estimated optimal SNR < snr_threshold - snr_margin, see select_candidates.
         '''
         if Nneeded is None:
             Nneeded = Ninj
@@ -414,7 +907,11 @@ class DataGeneratorBilbyFD:
         else:
             pass
 
-        for i_inj in range(Ninj):
+        candidates = np.arange(Ninj)
+        if preselect:
+            candidates = self.select_candidates(injection_parameters_all, candidates, snr_margin=snr_margin)
+
+        for i_inj in candidates:
             if self.Nsample >= Nneeded:
                 break 
             print(f"Injecting {i_inj}-th signal, {round(100*i_inj/Ninj,2)}% done")
@@ -468,8 +965,20 @@ class DataGeneratorBilbyFD:
         polarizations = {}
         for mode in ['plus', 'cross']:
             polarizations[mode] = {}
-            for part in ['amplitude', 'phase']:
+            for part in waveform_list[mode].keys():
                 polarizations[mode][part] = waveform_list[mode][part][index]
 
         return polarizations
 
+
+def _generate_waveform_shard(generator_kwargs, injection_parameters_shard, filename, seed_sequence):
+    '''
+    Worker of DataGeneratorBilbyFD.generate_waveforms_parallel. Writes to a temporary file first so that a killed worker never leaves a truncated shard.
+    '''
+    np.random.seed(seed_sequence.generate_state(1)[0]) # bilby draws from the global state
+    data_generator = DataGeneratorBilbyFD(**generator_kwargs, seed=seed_sequence)
+    data_generator.generate_waveforms(injection_parameters_shard)
+    tmpname = filename + '.tmp'
+    data_generator.save_waveform_data(tmpname)
+    os.replace(tmpname, filename)
+    return filename
@@ -1,12 +1,21 @@
 import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, IterableDataset, Sampler, get_worker_info
 import torchvision.transforms as transforms
 #from .utils import PARAMETER_NAMES_ALL_PRECESSINGBNS_BILBY
 from .utils import * 
+from .basis import load_basis, get_basis_store
+from .precalwf import LazyH5File, WaveformFileCache, WaveformFilePrefetcher
+from .detector import compute_detector_factors_vectorized, TorchDetectorResponse, get_detector_geometry
+from .svdops import SVDTimeShiftOperator, FusedStrainSimulator
+from bilby.core.utils import speed_of_light
 #from ..models.utils import project_strain_data_FDAPhi
 import pickle
 import random
+import os
+import hashlib
+import shutil
+from collections import OrderedDict
 
 
 def reparameterize_mass(mass):
@@ -347,6 +356,11 @@ class DatasetStrainFDFromFolder(Dataset):
 
 
 def loadVandVh(Vhfilepath, Nbasis):
+    if Vhfilepath.endswith('.npy'):
+        # memory-mapped, only the first Nbasis rows are read
+        Vh = load_basis(Vhfilepath, Nbasis)
+        Vh = np.array(Vh)
+        return Vh.T.conj(), Vh
     with open(Vhfilepath, 'rb') as f:
         Vh = pickle.load(f)
     if len(Vh)<Nbasis:
@@ -360,11 +374,23 @@ def loadVandVh(Vhfilepath, Nbasis):
 class DatasetSVDStrainFDFromSVDWFonGPU(Dataset):
     '''
     Simulate FD data in SVD space from pre-calculated SVD waveforms, optimized for GPU or CPU computation.
+
+    Waveform files are kept in a WaveformFileCache. With lazy_load=True (default) only open handles are cached and rows are read
+    when used, so memory does not depend on the cache and wf_cache_bytes has no effect, wf_cache_files bounds the number of open files.
+    With lazy_load=False whole files are loaded and wf_cache_bytes bounds the memory they take.
     '''
     def __init__(self, precalwf_filelist, parameter_names, data_generator, Nbasis, Vhfile,
                 dmin=10, dmax=200, dpower=1, loadwf=False, loadnoise=False, device='cuda',
-                complex = False, add_noise=True, fix_extrinsic=False, shuffle=True):
+                complex = False, add_noise=True, fix_extrinsic=False, shuffle=True, lazy_load=True,
+                wf_cache=None, wf_cache_bytes=0, wf_cache_files=16,
+                torch_detector_response=True, fused_detectors=True, seed=None, basis_cache_dir=None):
         self.precalwf_filelist = precalwf_filelist
+        # order of files in this epoch, see shuffle_wflist. precalwf_filelist is never changed
+        self.epoch_filelist = list(precalwf_filelist)
+        # random draws use self.rng, a numpy Generator seeded by seed and the DataLoader worker, see init_worker
+        self.seed = np.random.randint(2**31) if seed is None else seed
+        self._rng = None
+        self._rng_pid = None
         self.parameter_names = parameter_names
         self.data_generator = data_generator
         self.Nbasis = Nbasis
@@ -378,34 +404,59 @@ class DatasetSVDStrainFDFromSVDWFonGPU(Dataset):
         self.add_noise = add_noise
         self.fix_extrinsic = fix_extrinsic
         self.shuffle = shuffle
-
-        # Load V and Vh matrices and convert to tensors
-        self.V, self.Vh = loadVandVh(Vhfile, Nbasis)
-        self.V = torch.from_numpy(self.V).to(self.device).type(torch.complex64)
-        self.Vh = torch.from_numpy(self.Vh).to(self.device).type(torch.complex64)
-
-        
+        # lazy_load: keep the file open and read only the rows needed, instead of loading whole files
+        self.lazy_load = lazy_load
+        # LRU cache of files. wf_cache_bytes bounds files loaded into memory (lazy_load=False, 0 keeps only the last one),
+        # lazy files hold no data and are bounded by wf_cache_files. A WaveformFileCache can be shared between datasets.
+        if wf_cache is None:
+            wf_cache = WaveformFileCache(self.load_precalwf_file, max_bytes=wf_cache_bytes, max_files=wf_cache_files)
+        self.wf_cache = wf_cache
+
+        self.Vhfile = Vhfile
+        self.basis_cache_dir = basis_cache_dir
         self.farray = torch.from_numpy(data_generator.frequency_array_masked).float().to(self.device)
+        self.frequency_array_masked = data_generator.frequency_array_masked
+        self.data_frequency_array = data_generator.data_frequency_array
         self.ifos = data_generator.ifos
-        self.det_data = self.prepare_detector_data()
+        # frequency_weights: bins per point on a multibanded grid (ones otherwise)
+        self.noise_weights_list = [data_generator.frequency_weights/(data_generator.get_psd_masked(det)*det.duration/4) for det in self.ifos]
+        # antenna patterns and time delays computed by torch on self.device, instead of bilby calls
+        self.torch_detector_response = torch_detector_response
+        if torch_detector_response:
+            # GMST is linearised around the centre of the geocent_time draws (see update_injection_parameters), 
+            # and moved to the batch mean if the times are elsewhere
+            self.detector_response = TorchDetectorResponse(self.ifos, reference_time=0.).to(self.device)
+        # all detectors in one batched contraction instead of a loop over detectors, needs torch_detector_response
+        self.fused_detectors = fused_detectors and torch_detector_response
+        self.prepare_simulation()
         
-        testfile = load_dict_from_hdf5(precalwf_filelist[0])
+        testfile = self.wf_cache.get(precalwf_filelist[0])
         self.sample_per_file = len(testfile['injection_parameters']['chirp_mass'])
         self.Nfile = len(self.precalwf_filelist)
         self.Nsample = self.Nfile * self.sample_per_file 
-        self.cached_wf_file = testfile
-        self.cached_wf_file_index = 0
         
         self.shuffle_indexinfile()
             
+    def prepare_simulation(self):
+        '''
+        Bases and strain simulator. Not sent to DataLoader workers, which make them again from the basis store (see __setstate__).
+        '''
+        # shared by all datasets using Vhfile in this process, memory-mapped from .npy, V is a view of Vh
+        self.basis_store = get_basis_store(self.Vhfile, cache_dir=self.basis_cache_dir)
+        self.Vh = self.basis_store.get_Vh(self.Nbasis, self.device)
+        self.V = self.Vh.T.conj()
+        self.det_data = self.prepare_detector_data()
+        if self.fused_detectors:
+            self.strain_simulator = FusedStrainSimulator(self.Vh, self.whitened_V,
+                self.frequency_array_masked, reuse_output=not self.complex, device=self.device)
+
     def prepare_detector_data(self):
+        # [ndet, Nfreq, Nbasis], shared through the basis store and cached on disk if basis_cache_dir is given
+        self.whitened_V = self.basis_store.get_whitened_V(self.Nbasis, self.noise_weights_list, self.device, 
+                                                          frequency_array=self.data_frequency_array)
         det_data = {}
-        for det in self.ifos:
-            detname = det.name
-            psd = det.power_spectral_density_array[self.data_generator.frequency_mask]
-            psd = torch.from_numpy(psd).double().to(self.device)
-            whitened_V = (self.V.T * 1/(psd*det.duration/4)**0.5).T
-            det_data[detname] = {'whitened_V': whitened_V.type(torch.complex64)}
+        for i, det in enumerate(self.ifos):
+            det_data[det.name] = {'whitened_V': self.whitened_V[i]}
         return det_data
 
     def __len__(self):
@@ -429,6 +480,43 @@ class DatasetSVDStrainFDFromSVDWFonGPU(Dataset):
         else:
             return theta, torch.cat((x.real, x.imag)).float()
 
+    def __getitems__(self, indices):
+        '''
+        Samples of a list of indices made in one vectorized pass, used by DataLoader (torch>=2.1) instead of one __getitem__ per sample.
+        Returns a list of (theta, x) in the order of indices, collated as usual.
+        '''
+        if not self.fused_detectors:
+            return [self[index] for index in indices]
+        index_of_file, index_in_file = self.get_index(np.asarray(indices), self.sample_per_file)
+        index_in_file = self.random_index_in_file[index_in_file]
+        # read each file once, then put the samples back in the order of indices
+        _, first_appearance = np.unique(index_of_file, return_index=True)
+        hp_list, hc_list, injection_parameters_list, position_list = [], [], [], []
+        for i in index_of_file[np.sort(first_appearance)]:
+            wf_dict = self.get_precalwf_dict(i)
+            position = np.flatnonzero(index_of_file==i)
+            rows = index_in_file[position]
+            hp_list.append(self.get_svd_coefficients(wf_dict['waveform_polarizations']['plus'], rows))
+            hc_list.append(self.get_svd_coefficients(wf_dict['waveform_polarizations']['cross'], rows))
+            injection_parameters_list.append({key: wf_dict['injection_parameters'][key][rows] for key in ['chirp_mass', 'mass_ratio', 
+                    'a_1', 'a_2', 'tilt_1', 'tilt_2', 'phi_12', 'phi_jl', 'lambda_tilde', 'delta_lambda_tilde', 'theta_jn', 'phase']})
+            position_list.append(position)
+        inverse = np.argsort(np.concatenate(position_list))
+        hp_svd = torch.cat(hp_list)[torch.from_numpy(inverse).to(self.device)]
+        hc_svd = torch.cat(hc_list)[torch.from_numpy(inverse).to(self.device)]
+        injection_parameters = {key: np.concatenate([para[key] for para in injection_parameters_list])[inverse] 
+                                for key in injection_parameters_list[0]}
+        injection_parameters = self.update_injection_parameters_batch(injection_parameters)
+
+        dL = torch.from_numpy(injection_parameters['luminosity_distance']).to(self.device).unsqueeze(-1)
+        fp, fc, dt = self.compute_detector_factors_torch(injection_parameters)
+        x = self.strain_simulator(hp_svd/dL, hc_svd/dL, fp, fc, dt, add_noise=self.add_noise)
+
+        theta = self.get_theta(injection_parameters).T
+        if not self.complex:
+            x = torch.cat((x.real, x.imag), axis=1).float()
+        return list(zip(theta, x))
+
     def get_index(self, index, sample_per_file):
         index_of_file = index // sample_per_file
         index_in_file = index - index_of_file*sample_per_file
@@ -436,23 +524,27 @@ class DatasetSVDStrainFDFromSVDWFonGPU(Dataset):
         return index_of_file, index_in_file
     
     def get_precalwf_dict(self, index_of_file):
-        if self.cached_wf_file_index == index_of_file:
-            return self.cached_wf_file
-        else:
-            wf_dict = load_dict_from_hdf5(self.precalwf_filelist[index_of_file])
-            self.cached_wf_file = wf_dict
-            self.cached_wf_file_index = index_of_file
-            return wf_dict
+        return self.wf_cache.get(self.epoch_filelist[index_of_file])
+
+    def load_precalwf_file(self, filename):
+        if self.lazy_load:
+            return LazyH5File(filename)
+        return load_dict_from_hdf5(filename)
         
     def get_waveform_tensors(self, wf_dict, index_in_file):
         index_in_file = self.random_index_in_file[index_in_file]
-        hp_svd = (torch.from_numpy(wf_dict['waveform_polarizations']['plus']['amplitude'][index_in_file]) *\
-            torch.exp(1j*torch.from_numpy(wf_dict['waveform_polarizations']['plus']['phase'][index_in_file])).type(torch.complex64)).to(self.device)
-        hc_svd = (torch.from_numpy(wf_dict['waveform_polarizations']['cross']['amplitude'][index_in_file]) *\
-            torch.exp(1j*torch.from_numpy(wf_dict['waveform_polarizations']['cross']['phase'][index_in_file])).type(torch.complex64)).to(self.device)
+        hp_svd = self.get_svd_coefficients(wf_dict['waveform_polarizations']['plus'], index_in_file)
+        hc_svd = self.get_svd_coefficients(wf_dict['waveform_polarizations']['cross'], index_in_file)
         
         return hp_svd, hc_svd
 
+    def get_svd_coefficients(self, waveform_component, index):
+        if 'coefficients' in waveform_component:
+            # complex64 on disk, no conversion needed
+            return torch.from_numpy(waveform_component['coefficients'][index]).to(self.device)
+        return (torch.from_numpy(waveform_component['amplitude'][index]) *\
+            torch.exp(1j*torch.from_numpy(waveform_component['phase'][index])).type(torch.complex64)).to(self.device)
+
     def get_injection_parameters(self, wf_dict, index_in_file):
         index_in_file = self.random_index_in_file[index_in_file]
         injection_parameters = {key: wf_dict['injection_parameters'][key][index_in_file] for key in ['chirp_mass', 'mass_ratio', 'a_1', 'a_2', 'tilt_1', 'tilt_2', 'phi_12', 'phi_jl',
@@ -466,13 +558,22 @@ class DatasetSVDStrainFDFromSVDWFonGPU(Dataset):
     
     def compute_strain_tensors(self, hp_svd, hc_svd, injection_parameters):
         num_ifos = len(self.ifos)
+        if self.fused_detectors:
+            fp_all, fc_all, dt_all = self.compute_detector_factors_torch(injection_parameters)
+            return self.strain_simulator(hp_svd.unsqueeze(0), hc_svd.unsqueeze(0), fp_all, fc_all, dt_all, 
+                                         add_noise=self.add_noise)[0]
         #x_real = torch.zeros((num_ifos, self.Nbasis), dtype=torch.float32, device=self.device)
         #x_imag = torch.zeros((num_ifos, self.Nbasis), dtype=torch.float32, device=self.device)
         x = torch.zeros((num_ifos, self.Nbasis), dtype=torch.complex64, device=self.device)
+        if self.torch_detector_response:
+            fp_all, fc_all, dt_all = self.compute_detector_factors_torch(injection_parameters)
         for i, det in enumerate(self.ifos):
             detname = det.name
 
-            fp, fc, dt = self.compute_detector_factors(det, injection_parameters)
+            if self.torch_detector_response:
+                fp, fc, dt = fp_all[0,i], fc_all[0,i], dt_all[0,i]
+            else:
+                fp, fc, dt = self.compute_detector_factors(det, injection_parameters)
             phase2add = torch.exp(-1j * 2 * np.pi * dt * self.farray)
             Vh_recons = self.Vh * phase2add.unsqueeze(0)  # Ensure proper broadcasting
             
@@ -506,6 +607,16 @@ class DatasetSVDStrainFDFromSVDWFonGPU(Dataset):
             
         return fp, fc, dt
 
+    def compute_detector_factors_torch(self, injection_parameters):
+        '''
+        F+, Fx and dt of all detectors, [N, ndet] tensors on self.device.
+        '''
+        # numpy arrays in, so that the reference time of the GMST is checked on the host
+        ra, dec, tc, psi = [np.atleast_1d(injection_parameters[key]) for key in ['ra', 'dec', 'geocent_time', 'psi']]
+        fp, fc, time_shift = self.detector_response(ra, dec, tc, psi)
+        dt = torch.as_tensor(tc, dtype=torch.float64, device=self.device).unsqueeze(-1) + time_shift
+        return fp.float(), fc.float(), dt
+
     def get_theta(self, injection_parameters):
         theta = torch.tensor(np.array([injection_parameters[paraname] for paraname in self.parameter_names]), dtype=torch.float32).to(self.device)
         return theta
@@ -519,34 +630,103 @@ class DatasetSVDStrainFDFromSVDWFonGPU(Dataset):
             #injection_parameters['luminosity_distance'] = generate_random_distance(Nsample=1, low=self.dmin, high=self.dmax, power=self.dpower)[0]
             injection_parameters['luminosity_distance'] = 100
         else:
-            injection_parameters['ra'] = np.random.uniform(0, np.pi)
-            injection_parameters['dec'] = np.arcsin(np.random.uniform(-1, 1))
-            injection_parameters['psi'] = np.random.uniform(0, np.pi)
-            injection_parameters['geocent_time'] = np.random.uniform(-0.1, 0.1)
-            injection_parameters['luminosity_distance'] = generate_random_distance(Nsample=1, low=self.dmin, high=self.dmax, power=self.dpower)[0]
+            injection_parameters['ra'] = self.rng.uniform(0, np.pi)
+            injection_parameters['dec'] = np.arcsin(self.rng.uniform(-1, 1))
+            injection_parameters['psi'] = self.rng.uniform(0, np.pi)
+            injection_parameters['geocent_time'] = self.rng.uniform(-0.1, 0.1)
+            injection_parameters['luminosity_distance'] = generate_random_distance(Nsample=1, low=self.dmin, high=self.dmax, power=self.dpower, rng=self.rng)[0]
+    
+        return injection_parameters
+
+    def update_injection_parameters_batch(self, injection_parameters):
+        '''
+        update_injection_parameters for arrays of N samples.
+        '''
+        N = len(injection_parameters['chirp_mass'])
+        if self.fix_extrinsic:
+            injection_parameters['ra'] = np.zeros(N) + 1
+            injection_parameters['dec'] = np.zeros(N) + 1
+            injection_parameters['psi'] = np.zeros(N) + 1
+            injection_parameters['geocent_time'] = np.zeros(N) + 0
+            injection_parameters['luminosity_distance'] = np.zeros(N) + 100
+        else:
+            injection_parameters['ra'] = self.rng.uniform(0, np.pi, N)
+            injection_parameters['dec'] = np.arcsin(self.rng.uniform(-1, 1, N))
+            injection_parameters['psi'] = self.rng.uniform(0, np.pi, N)
+            injection_parameters['geocent_time'] = self.rng.uniform(-0.1, 0.1, N)
+            injection_parameters['luminosity_distance'] = generate_random_distance(Nsample=N, low=self.dmin, high=self.dmax, power=self.dpower, rng=self.rng)
     
         return injection_parameters
     
     def shuffle_wflist(self):
         if self.shuffle:
-            random.shuffle(self.precalwf_filelist)
+            self.epoch_filelist = [self.precalwf_filelist[i] for i in self.rng.permutation(self.Nfile)]
         
     def shuffle_indexinfile(self):
         if self.shuffle:
-            self.random_index_in_file = np.random.permutation(self.sample_per_file)
+            self.random_index_in_file = self.rng.permutation(self.sample_per_file)
         else:
             self.random_index_in_file = np.arange(self.sample_per_file)
 
+    @property
+    def rng(self):
+        # each process (DataLoader worker) gets its own generator
+        if self._rng is None or self._rng_pid != os.getpid():
+            worker_info = get_worker_info()
+            self.init_worker(worker_info.seed if worker_info is not None else 0)
+        return self._rng
+
+    def init_worker(self, worker_seed=0):
+        '''
+        Seed the generator of this process with (seed, worker_seed), and drop files cached by the parent process.
+        '''
+        self._rng = np.random.default_rng([self.seed, worker_seed])
+        self._rng_pid = os.getpid()
+        if worker_seed != 0:
+            self.wf_cache.clear()
+            self.wf_cache.reset_stats()
+
+    def __getstate__(self):
+        # sent to (spawned) DataLoader workers without the data generator, loaded files (see WaveformFileCache), generator,
+        # bases, time shift table and simulator buffers, see prepare_simulation. The bilby ifos are still sent.
+        state = self.__dict__.copy()
+        state['data_generator'] = None
+        state['_rng'] = None
+        state['_rng_pid'] = None
+        for key in ['basis_store', 'Vh', 'V', 'whitened_V', 'det_data', 'timeshift_operator', 'strain_simulator']:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.prepare_simulation()
+
+
 class DatasetSVDStrainFDFromSVDWFonGPUBatch(Dataset):
     '''
     Simulate FD data in SVD space from pre-calculated SVD waveforms, optimized for GPU or CPU computation.
 
     Load a batch of data, i.e. return [minibatch_size, dim1, dim2, ...]. The batch size should be 2^N. 
+
+    Waveform files are kept in a WaveformFileCache. With lazy_load=True (default) only open handles are cached and rows are read
+    when used, so memory does not depend on the cache and wf_cache_bytes has no effect, wf_cache_files bounds the number of open files.
+    With lazy_load=False whole files are loaded and wf_cache_bytes bounds the memory they take.
     '''
     def __init__(self, precalwf_filelist, parameter_names, data_generator, Nbasis, Vhfile,
                 dmin=10, dmax=200, dpower=1, loadwf=False, loadnoise=False, device='cuda',
-                complex=False, add_noise=True, minibatch_size=1, fix_extrinsic=False, shuffle=True):
+                complex=False, add_noise=True, minibatch_size=1, fix_extrinsic=False, shuffle=True, lazy_load=True,
+                wf_cache=None, wf_cache_bytes=0, wf_cache_files=16, prefetch_files=2, per_sample_extrinsic=True,
+                torch_detector_response=True, svd_timeshift=False, svd_timeshift_tolerance=1e-5, svd_timeshift_order=None, 
+                svd_timeshift_max_bytes=2**34, svd_timeshift_cache_dir=None,
+                fused_detectors=True, seed=None, basis_cache_dir=None, multiplicity=1, interleave_multiplicity=False, 
+                generation_chunk=256):
         self.precalwf_filelist = precalwf_filelist
+        # order of files in this epoch, see shuffle_wflist. precalwf_filelist is never changed
+        self.epoch_filelist = list(precalwf_filelist)
+        # random draws use self.rng, a numpy Generator seeded by seed and the DataLoader worker, see init_worker
+        self.seed = np.random.randint(2**31) if seed is None else seed
+        self._rng = None
+        self._rng_pid = None
         self.parameter_names = parameter_names
         self.data_generator = data_generator
         self.Nbasis = Nbasis
@@ -561,56 +741,151 @@ class DatasetSVDStrainFDFromSVDWFonGPUBatch(Dataset):
         self.add_noise = add_noise
         self.fix_extrinsic = fix_extrinsic
         self.shuffle = shuffle
-
-        # Load V and Vh matrices and convert to tensors
-        self.V, self.Vh = loadVandVh(Vhfile, Nbasis)
-        self.V = torch.from_numpy(self.V).to(self.device).type(torch.complex64)
-        self.Vh = torch.from_numpy(self.Vh).to(self.device).type(torch.complex64)
-
-        
+        # per_sample_extrinsic: draw ra, dec, psi and geocent_time for every sample instead of one set per minibatch
+        self.per_sample_extrinsic = per_sample_extrinsic
+        # multiplicity: K extrinsic and noise realizations of every loaded waveform, the dataset is K times larger for the same I/O.
+        # interleave_multiplicity: spread the K copies over K batches (made together from minibatch_size waveforms) 
+        # instead of putting them in the same batch (minibatch_size/K waveforms per batch). The K batches of a block must come from
+        # the same process, so with several DataLoader workers use DatasetSVDStrainFDFromSVDWFonGPUIterable instead
+        self.multiplicity = multiplicity
+        self.interleave_multiplicity = interleave_multiplicity
+        if multiplicity>1 and not interleave_multiplicity and minibatch_size % multiplicity != 0:
+            raise ValueError(f"minibatch_size ({minibatch_size}) should be a multiple of multiplicity ({multiplicity})!")
+        self._interleaved_block = None
+        # lazy_load: keep the file open and read only the rows needed, instead of loading whole files
+        self.lazy_load = lazy_load
+        # LRU cache of files. wf_cache_bytes bounds files loaded into memory (lazy_load=False, 0 keeps only the last one),
+        # lazy files hold no data and are bounded by wf_cache_files. A WaveformFileCache can be shared between datasets.
+        if wf_cache is None:
+            wf_cache = WaveformFileCache(self.load_precalwf_file, max_bytes=wf_cache_bytes, max_files=wf_cache_files)
+        self.wf_cache = wf_cache
+        # load the next prefetch_files files of the epoch in the background. Opening lazy files reads nothing, their rows are 
+        # read ahead instead (see DatasetSVDStrainFDFromSVDWFonGPUIterable) and waiting for them is counted in prefetcher.io_wait_time
+        self.prefetcher = WaveformFilePrefetcher(self.wf_cache, depth=0 if lazy_load else prefetch_files)
+
+        self.Vhfile = Vhfile
+        self.basis_cache_dir = basis_cache_dir
         self.farray = torch.from_numpy(data_generator.frequency_array_masked).float().to(self.device)
+        self.frequency_array_masked = data_generator.frequency_array_masked
+        self.data_frequency_array = data_generator.data_frequency_array
         self.ifos = data_generator.ifos
-        self.det_data = self.prepare_detector_data()
+        # frequency_weights: bins per point on a multibanded grid (ones otherwise)
+        self.noise_weights_list = [data_generator.frequency_weights/(data_generator.get_psd_masked(det)*det.duration/4) for det in self.ifos]
+        # antenna patterns and time delays computed by torch on self.device, instead of bilby calls
+        self.torch_detector_response = torch_detector_response
+        if torch_detector_response:
+            # GMST is linearised around the centre of the geocent_time draws (see update_injection_parameters), 
+            # and moved to the batch mean if the times are elsewhere
+            self.detector_response = TorchDetectorResponse(self.ifos, reference_time=0.).to(self.device)
+        # time shifts with a precomputed Nbasis x Nbasis operator table, see SVDTimeShiftOperator. The table takes 
+        # ~11 GB for 3 detectors, Nbasis=512 and 50-1024 Hz at the default tolerance, svd_timeshift_max_bytes is its limit
+        self.svd_timeshift = svd_timeshift
+        self.svd_timeshift_options = {'order': svd_timeshift_order, 'tolerance': svd_timeshift_tolerance, 
+                                      'max_bytes': svd_timeshift_max_bytes, 'cache_dir': svd_timeshift_cache_dir}
+        # all detectors in one batched contraction instead of a loop over detectors, needs torch_detector_response.
+        # generation_chunk: samples simulated at a time, bounds the frequency-domain buffers whatever the batch size
+        # (FusedStrainSimulator.get_chunk_size gives the one for a memory budget)
+        self.fused_detectors = fused_detectors and torch_detector_response
+        self.generation_chunk = generation_chunk
+        self.prepare_simulation()
         
-        testfile = load_dict_from_hdf5(precalwf_filelist[0])
+        testfile = self.wf_cache.get(precalwf_filelist[0])
         self.sample_per_file = len(testfile['injection_parameters']['chirp_mass'])
         #if self.sample_per_file<self.minibatch_size:
         #    raise ValueError("Sample per file < batch size!")
         self.Nfile = len(self.precalwf_filelist)
         self.Nsample = self.Nfile * self.sample_per_file 
-        self.cached_wf_file = testfile
-        self.cached_wf_file_index = 0
+        self.prefetcher.set_order(self.epoch_filelist)
             
         self.shuffle_indexinfile()
         
+    def prepare_simulation(self):
+        '''
+        Bases, time shift operator and strain simulator. Not sent to DataLoader workers, which make them again from the 
+        basis store and svd_timeshift cache_dir (see __setstate__).
+        '''
+        # shared by all datasets using Vhfile in this process, memory-mapped from .npy, V is a view of Vh
+        self.basis_store = get_basis_store(self.Vhfile, cache_dir=self.basis_cache_dir)
+        self.Vh = self.basis_store.get_Vh(self.Nbasis, self.device)
+        self.V = self.Vh.T.conj()
+        self.det_data = self.prepare_detector_data()
+        if self.svd_timeshift:
+            # geocent_time is drawn from [-0.1, 0.1], plus the light travel time from the geocenter
+            _, vertices = get_detector_geometry(self.ifos)
+            max_delay = np.max(np.linalg.norm(vertices, axis=-1)) / speed_of_light
+            self.timeshift_operator = SVDTimeShiftOperator(self.Vh, [self.det_data[det.name]['whitened_V'] for det in self.ifos],
+                self.frequency_array_masked, -0.1-max_delay, 0.1+max_delay, device=self.device, **self.svd_timeshift_options)
+        if self.fused_detectors:
+            self.strain_simulator = FusedStrainSimulator(self.Vh, self.whitened_V,
+                self.frequency_array_masked, timeshift_operator=self.timeshift_operator if self.svd_timeshift else None,
+                reuse_output=not self.complex, chunk_size=self.generation_chunk, device=self.device)
+
     def prepare_detector_data(self):
+        # [ndet, Nfreq, Nbasis], shared through the basis store and cached on disk if basis_cache_dir is given
+        self.whitened_V = self.basis_store.get_whitened_V(self.Nbasis, self.noise_weights_list, self.device, 
+                                                          frequency_array=self.data_frequency_array)
         det_data = {}
-        for det in self.ifos:
-            detname = det.name
-            psd = det.power_spectral_density_array[self.data_generator.frequency_mask]
-            psd = torch.from_numpy(psd).double().to(self.device)
-            whitened_V = (self.V.T * 1/(psd*det.duration/4)**0.5).T
-            det_data[detname] = {'whitened_V': whitened_V.type(torch.complex64)}
+        for i, det in enumerate(self.ifos):
+            det_data[det.name] = {'whitened_V': self.whitened_V[i]}
         return det_data
 
     def __len__(self):
-        return len(self.precalwf_filelist) * self.sample_per_file // self.minibatch_size
+        if self.interleave_multiplicity:
+            return self.Nsample // self.minibatch_size * self.multiplicity
+        return self.Nsample * self.multiplicity // self.minibatch_size
 
     def __getitem__(self, index):
-        index = index*self.minibatch_size
-        
-        index_end = index + self.minibatch_size
-        index_of_file, index_in_file = self.get_index(index, self.sample_per_file)
-        index_of_file_end, index_in_file_end = self.get_index(index_end, self.sample_per_file)
-        if index_of_file_end>=len(self.precalwf_filelist):
-            index_of_file_end = len(self.precalwf_filelist)-1
-            index_in_file_end = self.sample_per_file
-        wf_dict_list = []
-        for i in range(index_of_file, index_of_file_end+1):
-            wf_dict_list.append(self.get_precalwf_dict(i))
-        
-        hp_svd, hc_svd = self.get_waveform_tensors_batch(wf_dict_list, index_in_file, index_in_file_end)
-        injection_parameters = self.get_injection_parameters_batch(wf_dict_list,index_in_file, index_in_file_end)
+        K = self.multiplicity
+        if not self.interleave_multiplicity:
+            return self.get_batch(index*self.minibatch_size//K, self.minibatch_size//K, multiplicity=K)
+
+        worker_info = get_worker_info()
+        if worker_info is not None and worker_info.num_workers > 1:
+            # each worker would make the whole block with its own draws and keep only its batches of it,
+            # so copies of a waveform would be duplicated or lost
+            raise ValueError("interleave_multiplicity does not work with several DataLoader workers, "
+                             "use DatasetSVDStrainFDFromSVDWFonGPUIterable (a block stays in one worker) or num_workers<=1!")
+        # batches index//K*K to index//K*K+K-1 are made together, keep them until the next block is asked for
+        block = index // K
+        if self._interleaved_block is None or self._interleaved_block[0] != block:
+            theta, x = self.get_batch(block*self.minibatch_size, self.minibatch_size, multiplicity=K)
+            theta, x = self.shuffle_batch(theta, x)
+            self._interleaved_block = (block, theta, x)
+        _, theta, x = self._interleaved_block
+        i = index % K
+        return theta[i*self.minibatch_size:(i+1)*self.minibatch_size], x[i*self.minibatch_size:(i+1)*self.minibatch_size]
+
+    def shuffle_batch(self, theta, x):
+        permutation = torch.from_numpy(self.rng.permutation(len(theta))).to(theta.device)
+        return theta[permutation], x[permutation]
+
+    def get_batch(self, index, batch_size, filelist=None, multiplicity=1):
+        '''
+        Samples index to index+batch_size (in the order of filelist, default self.epoch_filelist), made in one call.
+        '''
+        if filelist is None:
+            filelist = self.epoch_filelist
+        sample_index = np.arange(index, min(index + batch_size, len(filelist)*self.sample_per_file))
+        index_of_file, index_in_file = self.get_index(sample_index, self.sample_per_file)
+        return self.get_batch_from_samples(index_of_file, self.random_index_in_file[index_in_file], filelist=filelist, 
+                                           multiplicity=multiplicity)
+
+    def get_batch_from_samples(self, index_of_file, index_in_file, filelist=None, multiplicity=1, samples=None):
+        '''
+        Batch of the samples in rows index_in_file of files index_of_file (arrays of the same length) of filelist, made in one call.
+        Each file is read once, in the order of first appearance, and the samples come out grouped by file.
+        multiplicity: repeat every waveform multiplicity times (consecutively) with independent extrinsic parameters and noise.
+        samples: read_samples of the same arguments if they are already read (e.g. ahead, in the prefetcher's thread).
+        '''
+        if samples is None:
+            samples = self.read_samples(index_of_file, index_in_file, filelist)
+        hp, hc, injection_parameters = samples
+        hp_svd = torch.from_numpy(hp).to(self.device)
+        hc_svd = torch.from_numpy(hc).to(self.device)
+        if multiplicity>1:
+            hp_svd = hp_svd.repeat_interleave(multiplicity, dim=0)
+            hc_svd = hc_svd.repeat_interleave(multiplicity, dim=0)
+            injection_parameters = {key: np.repeat(value, multiplicity) for key, value in injection_parameters.items()}
         injection_parameters = self.update_injection_parameters_batch(injection_parameters)
         
         dL = torch.from_numpy(injection_parameters['luminosity_distance']).to(self.device).unsqueeze(-1)
@@ -626,93 +901,115 @@ class DatasetSVDStrainFDFromSVDWFonGPUBatch(Dataset):
         else:
             return theta, torch.cat((x.real, x.imag), axis=1).float()
 
+    def read_samples(self, index_of_file, index_in_file, filelist=None):
+        '''
+        SVD coefficients of hp and hc [N, Nbasis] (numpy) and intrinsic parameters of the samples, read from disk (or the cache) 
+        file by file, in the order of first appearance. Only reads, so it can run in a background thread.
+        '''
+        if filelist is None:
+            filelist = self.epoch_filelist
+        _, first_appearance = np.unique(index_of_file, return_index=True)
+        hp_list, hc_list, injection_parameters_list = [], [], []
+        for i in index_of_file[np.sort(first_appearance)]:
+            wf_dict = self.get_precalwf_dict(i, filelist)
+            rows = index_in_file[index_of_file==i]
+            hp_list.append(self.read_svd_coefficients(wf_dict['waveform_polarizations']['plus'], rows))
+            hc_list.append(self.read_svd_coefficients(wf_dict['waveform_polarizations']['cross'], rows))
+            injection_parameters_list.append(self.get_injection_parameters_batch(wf_dict, rows))
+        injection_parameters = {key: np.concatenate([para[key] for para in injection_parameters_list]) 
+                                for key in injection_parameters_list[0]}
+        return np.concatenate(hp_list), np.concatenate(hc_list), injection_parameters
+
     def get_index(self, index, sample_per_file):
         index_of_file = index // sample_per_file
         index_in_file = index - index_of_file*sample_per_file
 
         return index_of_file, index_in_file
     
-    def get_precalwf_dict(self, index_of_file):
-        if self.cached_wf_file_index == index_of_file:
-            return self.cached_wf_file
-        else:
-            try:
-                wf_dict = load_dict_from_hdf5(self.precalwf_filelist[index_of_file])
-            except:
-                raise Exception(f'index_of_file: {index_of_file}')
-            self.cached_wf_file = wf_dict
-            self.cached_wf_file_index = index_of_file
-            return wf_dict
+    def get_precalwf_dict(self, index_of_file, filelist=None):
+        if filelist is None:
+            filelist = self.epoch_filelist
+        try:
+            return self.prefetcher.get(filelist[index_of_file])
+        except:
+            raise Exception(f'index_of_file: {index_of_file}')
+
+    def load_precalwf_file(self, filename):
+        if self.lazy_load:
+            return LazyH5File(filename, timer=self.prefetcher)
+        return load_dict_from_hdf5(filename)
         
-    def get_waveform_tensors_batch(self, wf_dict_list, index_in_file, index_in_file_end):
-        for i, wf_dict in enumerate(wf_dict_list):
-            if i==len(wf_dict_list)-1:
-                end_index = index_in_file_end
-            else:
-                end_index = self.sample_per_file
-            if i==0:
-                index = self.random_index_in_file[index_in_file:end_index]
-                hp_svd = (torch.from_numpy(wf_dict['waveform_polarizations']['plus']['amplitude'][index]) *\
-                    torch.exp(1j*torch.from_numpy(wf_dict['waveform_polarizations']['plus']['phase'][index])).type(torch.complex64)).to(self.device)
-                hc_svd = (torch.from_numpy(wf_dict['waveform_polarizations']['cross']['amplitude'][index]) *\
-                    torch.exp(1j*torch.from_numpy(wf_dict['waveform_polarizations']['cross']['phase'][index])).type(torch.complex64)).to(self.device)
-            else:
-                index = self.random_index_in_file[index_in_file:end_index]
-                hp_svd_new = (torch.from_numpy(wf_dict['waveform_polarizations']['plus']['amplitude'][index]) *\
-                    torch.exp(1j*torch.from_numpy(wf_dict['waveform_polarizations']['plus']['phase'][index])).type(torch.complex64)).to(self.device)
-                hc_svd_new = (torch.from_numpy(wf_dict['waveform_polarizations']['cross']['amplitude'][index]) *\
-                    torch.exp(1j*torch.from_numpy(wf_dict['waveform_polarizations']['cross']['phase'][index])).type(torch.complex64)).to(self.device)
-
-                hp_svd = torch.cat((hp_svd,hp_svd_new))
-                hc_svd = torch.cat((hc_svd,hc_svd_new))
-                    
-            
+    def get_waveform_tensors_batch(self, wf_dict, index):
+        hp_svd = self.get_svd_coefficients(wf_dict['waveform_polarizations']['plus'], index)
+        hc_svd = self.get_svd_coefficients(wf_dict['waveform_polarizations']['cross'], index)
         return hp_svd, hc_svd
 
-    def get_injection_parameters_batch(self, wf_dict_list, index_in_file, index_in_file_end):
-        para_name_list = ['chirp_mass', 'mass_ratio', 'a_1', 'a_2', 'tilt_1', 'tilt_2', 'phi_12', 'phi_jl',
-                    'lambda_tilde', 'delta_lambda_tilde', 'theta_jn', 'phase']
-        for i, wf_dict in enumerate(wf_dict_list):
-            if i==len(wf_dict_list)-1:
-                end_index = index_in_file_end
-            else:
-                end_index = self.sample_per_file
+    def get_svd_coefficients(self, waveform_component, index):
+        return torch.from_numpy(self.read_svd_coefficients(waveform_component, index)).to(self.device)
 
-            index_random = self.random_index_in_file[index_in_file:end_index]
-            if i==0:
-                injection_parameters = {key: wf_dict['injection_parameters'][key][index_random] for key in para_name_list}
-            else:
-                injection_parameters = {key: np.append(injection_parameters[key], wf_dict['injection_parameters'][key][index_random]) for key in para_name_list}
+    def read_svd_coefficients(self, waveform_component, index):
+        if 'coefficients' in waveform_component:
+            # complex64 on disk, no conversion needed
+            return waveform_component['coefficients'][index]
+        return (waveform_component['amplitude'][index] * np.exp(1j*waveform_component['phase'][index])).astype(np.complex64)
 
-        return injection_parameters
+    def get_injection_parameters_batch(self, wf_dict, index):
+        para_name_list = ['chirp_mass', 'mass_ratio', 'a_1', 'a_2', 'tilt_1', 'tilt_2', 'phi_12', 'phi_jl',
+                    'lambda_tilde', 'delta_lambda_tilde', 'theta_jn', 'phase']
+        return {key: wf_dict['injection_parameters'][key][index] for key in para_name_list}
 
-    def get_noise_tensors_batch(self, ):
-        white_noise = (torch.randn((self.minibatch_size, self.Nbasis), device=self.device) + \
-                       1j * torch.randn((self.minibatch_size, self.Nbasis), device=self.device)).type(torch.complex64)
+    def get_noise_tensors_batch(self, N=None):
+        if N is None:
+            N = self.minibatch_size
+        white_noise = (torch.randn((N, self.Nbasis), device=self.device) + \
+                       1j * torch.randn((N, self.Nbasis), device=self.device)).type(torch.complex64)
 
         return white_noise
     
     def compute_strain_tensors_batch(self, hp_svd, hc_svd, injection_parameters):
         num_ifos = len(self.ifos)
+        if self.fused_detectors:
+            fp_all, fc_all, dt_all = self.compute_detector_factors_torch(injection_parameters)
+            N = len(hp_svd)
+            # one set of extrinsic parameters for the minibatch if not per_sample_extrinsic
+            return self.strain_simulator(hp_svd, hc_svd, fp_all.expand(N, -1), fc_all.expand(N, -1), dt_all.expand(N, -1),
+                                         add_noise=self.add_noise)
         #x_real = torch.zeros((self.minibatch_size, num_ifos, self.Nbasis), dtype=torch.float32, device=self.device)
         #x_imag = torch.zeros((self.minibatch_size, num_ifos, self.Nbasis), dtype=torch.float32, device=self.device)
-        x = torch.zeros((self.minibatch_size, num_ifos, self.Nbasis), dtype=torch.complex64, device=self.device)
+        x = torch.zeros((len(hp_svd), num_ifos, self.Nbasis), dtype=torch.complex64, device=self.device)
+        if self.torch_detector_response:
+            fp_all, fc_all, dt_all = self.compute_detector_factors_torch(injection_parameters)
         for i,det in enumerate(self.ifos):
             detname = det.name
         
-            fp, fc, dt = self.compute_detector_factors_batch(det, injection_parameters)
-            phase2add = torch.exp(-1j * 2 * np.pi * dt * self.farray)
-            Vh_recons = (self.Vh * phase2add.unsqueeze(0)).type(torch.complex64)  # Ensure proper broadcasting            
+            if self.torch_detector_response and self.per_sample_extrinsic:
+                fp, fc, dt = fp_all[:,i:i+1], fc_all[:,i:i+1], dt_all[:,i:i+1]
+            elif self.torch_detector_response:
+                fp, fc, dt = fp_all[0,i], fc_all[0,i], dt_all[0,i]
+            else:
+                fp, fc, dt = self.compute_detector_factors_batch(det, injection_parameters)
             hh = (fp*hp_svd + fc*hc_svd).type(torch.complex64)
+            if not self.svd_timeshift:
+                phase2add = torch.exp(-1j * 2 * np.pi * dt * self.farray)
+            if not self.per_sample_extrinsic and not self.svd_timeshift:
+                Vh_recons = (self.Vh * phase2add.unsqueeze(0)).type(torch.complex64)  # Ensure proper broadcasting            
 
             #h_svd = torch.matmul(torch.bmm(hh.unsqueeze(1), Vh_recons).squeeze(1),
             #                     self.det_data[detname]['whitened_V'])
-            h_svd = torch.matmul(torch.matmul(hh, Vh_recons),
-                                 self.det_data[detname]['whitened_V'])
+            if self.svd_timeshift:
+                dt = torch.as_tensor(dt, dtype=torch.float64, device=self.device).reshape(-1).expand(len(hh))
+                h_svd = self.timeshift_operator.apply(hh, dt, i)
+            elif self.per_sample_extrinsic:
+                # phase2add is [minibatch_size, Nfreq], shift each sample in frequency domain then project to whitened SVD space
+                h_svd = torch.matmul(torch.matmul(hh, self.Vh) * phase2add.type(torch.complex64),
+                                     self.det_data[detname]['whitened_V'])
+            else:
+                h_svd = torch.matmul(torch.matmul(hh, Vh_recons),
+                                     self.det_data[detname]['whitened_V'])
             
             
             if self.add_noise:
-                n_svd = self.get_noise_tensors_batch()
+                n_svd = self.get_noise_tensors_batch(len(hh))
                 d_svd = h_svd + n_svd
             else:
                 d_svd = h_svd
@@ -748,6 +1045,16 @@ class DatasetSVDStrainFDFromSVDWFonGPUBatch(Dataset):
             fc_tensor[i] = fc
             dt_tensor[i] = dt
         '''
+        if self.per_sample_extrinsic:
+            # all samples at once, [minibatch_size, 1] tensors
+            fp, fc, time_shift = compute_detector_factors_vectorized(det.detector_tensor[None], det.vertex[None],
+                injection_parameters['ra'], injection_parameters['dec'], injection_parameters['geocent_time'], injection_parameters['psi'])
+            dt = injection_parameters['geocent_time'] + time_shift[:,0]
+            fp = torch.from_numpy(fp).float().to(self.device)
+            fc = torch.from_numpy(fc).float().to(self.device)
+            dt = torch.from_numpy(dt).unsqueeze(-1).to(self.device)
+            return fp, fc, dt
+
         ra = injection_parameters['ra'][0]
         dec = injection_parameters['dec'][0]
         tc = injection_parameters['geocent_time'][0]
@@ -762,38 +1069,358 @@ class DatasetSVDStrainFDFromSVDWFonGPUBatch(Dataset):
         
         #return fp_tensor.unsqueeze(-1), fc_tensor.unsqueeze(-1), dt_tensor.unsqueeze(-1)
         return fp, fc, dt
+
+    def compute_detector_factors_torch(self, injection_parameters):
+        '''
+        F+, Fx and dt of all detectors, [N, ndet] tensors on self.device.
+        '''
+        # numpy arrays in, so that the reference time of the GMST is checked on the host
+        ra, dec, tc, psi = [np.atleast_1d(injection_parameters[key]) for key in ['ra', 'dec', 'geocent_time', 'psi']]
+        fp, fc, time_shift = self.detector_response(ra, dec, tc, psi)
+        dt = torch.as_tensor(tc, dtype=torch.float64, device=self.device).unsqueeze(-1) + time_shift
+        return fp.float(), fc.float(), dt
     
     def get_theta(self, injection_parameters):
         theta = torch.tensor(np.array([injection_parameters[paraname] for paraname in self.parameter_names]), dtype=torch.float32).to(self.device).T
         return theta
     
     def update_injection_parameters_batch(self, injection_parameters):
+        N = len(injection_parameters['chirp_mass'])
         if self.fix_extrinsic:
-            injection_parameters['ra'] = np.zeros(self.minibatch_size) + 1
-            injection_parameters['dec'] = np.zeros(self.minibatch_size) + 1
-            injection_parameters['psi'] = np.zeros(self.minibatch_size) + 1
-            injection_parameters['geocent_time'] = np.zeros(self.minibatch_size) + 0
-            #injection_parameters['luminosity_distance'] = generate_random_distance(Nsample=self.minibatch_size, low=self.dmin, high=self.dmax, power=self.dpower)
-            injection_parameters['luminosity_distance'] = np.zeros(self.minibatch_size) + 100
+            injection_parameters['ra'] = np.zeros(N) + 1
+            injection_parameters['dec'] = np.zeros(N) + 1
+            injection_parameters['psi'] = np.zeros(N) + 1
+            injection_parameters['geocent_time'] = np.zeros(N) + 0
+            #injection_parameters['luminosity_distance'] = generate_random_distance(Nsample=N, low=self.dmin, high=self.dmax, power=self.dpower, rng=self.rng)
+            injection_parameters['luminosity_distance'] = np.zeros(N) + 100
     
+        elif self.per_sample_extrinsic:
+            injection_parameters['ra'] = self.rng.uniform(0, np.pi, N)
+            injection_parameters['dec'] = np.arcsin(self.rng.uniform(-1, 1, N))
+            injection_parameters['psi'] = self.rng.uniform(0, np.pi, N)
+            injection_parameters['geocent_time'] = self.rng.uniform(-0.1, 0.1, N)
+            injection_parameters['luminosity_distance'] = generate_random_distance(Nsample=N, low=self.dmin, high=self.dmax, power=self.dpower, rng=self.rng)
         else:
-            injection_parameters['ra'] = np.zeros(self.minibatch_size) + np.random.uniform(0, np.pi)
-            injection_parameters['dec'] = np.zeros(self.minibatch_size) + np.arcsin(np.random.uniform(-1, 1))
-            injection_parameters['psi'] = np.zeros(self.minibatch_size) + np.random.uniform(0, np.pi)
-            injection_parameters['geocent_time'] = np.zeros(self.minibatch_size) + np.random.uniform(-0.1, 0.1)
-            injection_parameters['luminosity_distance'] = generate_random_distance(Nsample=self.minibatch_size, low=self.dmin, high=self.dmax, power=self.dpower)
+            injection_parameters['ra'] = np.zeros(N) + self.rng.uniform(0, np.pi)
+            injection_parameters['dec'] = np.zeros(N) + np.arcsin(self.rng.uniform(-1, 1))
+            injection_parameters['psi'] = np.zeros(N) + self.rng.uniform(0, np.pi)
+            injection_parameters['geocent_time'] = np.zeros(N) + self.rng.uniform(-0.1, 0.1)
+            injection_parameters['luminosity_distance'] = generate_random_distance(Nsample=N, low=self.dmin, high=self.dmax, power=self.dpower, rng=self.rng)
         
         return injection_parameters
     
     def shuffle_wflist(self):
         if self.shuffle:
-            random.shuffle(self.precalwf_filelist)
+            self.epoch_filelist = [self.precalwf_filelist[i] for i in self.rng.permutation(self.Nfile)]
+        self.prefetcher.set_order(self.epoch_filelist)
         
     def shuffle_indexinfile(self):
         if self.shuffle:
-            self.random_index_in_file = np.random.permutation(self.sample_per_file)
+            self.random_index_in_file = self.rng.permutation(self.sample_per_file)
+        else:
+            self.random_index_in_file = np.arange(self.sample_per_file)
+
+    @property
+    def rng(self):
+        # each process (DataLoader worker) gets its own generator
+        if self._rng is None or self._rng_pid != os.getpid():
+            worker_info = get_worker_info()
+            self.init_worker(worker_info.seed if worker_info is not None else 0)
+        return self._rng
+
+    def init_worker(self, worker_seed=0):
+        '''
+        Seed the generator of this process with (seed, worker_seed), and drop files cached by the parent process.
+        '''
+        self._rng = np.random.default_rng([self.seed, worker_seed])
+        self._rng_pid = os.getpid()
+        if worker_seed != 0:
+            self.wf_cache.clear()
+            self.wf_cache.reset_stats()
+
+    def __getstate__(self):
+        # sent to (spawned) DataLoader workers without the data generator, loaded files (see WaveformFileCache), generator,
+        # bases, time shift table and simulator buffers, see prepare_simulation. The bilby ifos are still sent.
+        state = self.__dict__.copy()
+        state['data_generator'] = None
+        state['_rng'] = None
+        state['_rng_pid'] = None
+        for key in ['basis_store', 'Vh', 'V', 'whitened_V', 'det_data', 'timeshift_operator', 'strain_simulator']:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.prepare_simulation()
+
+
+class DatasetSVDStrainFDFromSVDWFonGPUIterable(DatasetSVDStrainFDFromSVDWFonGPUBatch, IterableDataset):
+    '''
+    Streaming version of DatasetSVDStrainFDFromSVDWFonGPUBatch. Iterating yields full training batches theta [batch_size, npara], 
+    x [batch_size, nchannel, Nbasis], each made in one vectorized call, so use DataLoader(dataset, batch_size=None) 
+    (no collation, no reshaping in the training step), or iterate over the dataset directly.
+
+    set_epoch(epoch) sets the (seeded) file and sample order of the next pass, the DataLoader does not need to be rebuilt.
+    With DataLoader workers, each worker makes batches from its own share of the files.
+    shuffle_window: mix samples of shuffle_window files in every batch (block shuffle) instead of taking files one after another.
+    multiplicity/interleave_multiplicity: as in DatasetSVDStrainFDFromSVDWFonGPUBatch, batches stay batch_size.
+    drop_last: drop the last incomplete batch of each worker. len() is the number of batches without workers.
+    read_ahead: with lazy_load, read the rows of the next chunk in the prefetcher's thread while the current one is simulated
+    (whole files are prefetched by the prefetcher without lazy_load).
+    '''
+    def __init__(self, precalwf_filelist, parameter_names, data_generator, Nbasis, Vhfile, batch_size=4096, drop_last=True, 
+                 shuffle_window=None, read_ahead=True, **kwargs):
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.read_ahead = read_ahead
+        # shuffle samples across shuffle_window files at a time, see block_shuffle_indices (needs a cache of shuffle_window files)
+        self.shuffle_window = shuffle_window
+        self.epoch = 0
+        super().__init__(precalwf_filelist, parameter_names, data_generator, Nbasis, Vhfile, minibatch_size=batch_size, **kwargs)
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        '''
+        File and sample order of epoch (seeded by seed and epoch), the same in all workers.
+        '''
+        self.epoch = epoch
+        if self.shuffle:
+            rng = np.random.default_rng([self.seed, epoch])
+            self.epoch_filelist = [self.precalwf_filelist[i] for i in rng.permutation(self.Nfile)]
+            self.random_index_in_file = rng.permutation(self.sample_per_file)
         else:
+            self.epoch_filelist = list(self.precalwf_filelist)
             self.random_index_in_file = np.arange(self.sample_per_file)
 
+    def get_worker_filelist(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return self.epoch_filelist
+        return self.epoch_filelist[worker_info.id::worker_info.num_workers]
 
+    def get_chunk_size(self):
+        '''
+        Number of waveforms loaded per call: batch_size, or batch_size/multiplicity if the copies stay in one batch.
+        '''
+        if self.interleave_multiplicity:
+            return self.batch_size
+        return self.batch_size // self.multiplicity
+
+    def get_number_of_batches(self, Nsample):
+        chunk_size = self.get_chunk_size()
+        if not self.interleave_multiplicity:
+            return Nsample // chunk_size if self.drop_last else int(np.ceil(Nsample / chunk_size))
+        Nbatch = Nsample // chunk_size * self.multiplicity
+        if not self.drop_last:
+            # the last, incomplete chunk
+            Nbatch += int(np.ceil(Nsample % chunk_size * self.multiplicity / self.batch_size))
+        return Nbatch
+
+    def __len__(self):
+        return self.get_number_of_batches(self.Nsample)
+
+    def __iter__(self):
+        filelist = self.get_worker_filelist()
+        Nsample = len(filelist) * self.sample_per_file
+        if self.shuffle_window is None:
+            order = np.arange(Nsample)
+            index_of_file, index_in_file = self.get_index(order, self.sample_per_file)
+            index_in_file = self.random_index_in_file[index_in_file]
+            self.prefetcher.set_order(filelist)
+        else:
+            worker_info = get_worker_info()
+            worker_id = 0 if worker_info is None else worker_info.id
+            rng = np.random.default_rng([self.seed, self.epoch, worker_id])
+            order = block_shuffle_indices(len(filelist), self.sample_per_file, self.shuffle_window, rng)
+            index_of_file, index_in_file = self.get_index(order, self.sample_per_file)
+            _, first_appearance = np.unique(index_of_file, return_index=True)
+            self.prefetcher.set_order([filelist[i] for i in index_of_file[np.sort(first_appearance)]])
+
+        chunk_size = self.get_chunk_size()
+        Nchunk = Nsample // chunk_size if self.drop_last else int(np.ceil(Nsample / chunk_size))
+        chunks = [slice(i * chunk_size, (i+1) * chunk_size) for i in range(Nchunk)]
+        # only reading lazy files in the background thread, whole files are loaded there by the prefetcher
+        read_ahead = self.read_ahead and self.lazy_load
+        future = None
+        for i, chunk in enumerate(chunks):
+            samples = None
+            if read_ahead:
+                if future is None:
+                    future = self.prefetcher.submit(self.read_samples, index_of_file[chunk], index_in_file[chunk], filelist)
+                samples = self.prefetcher.result(future)
+                future = None
+                if i+1 < Nchunk:
+                    future = self.prefetcher.submit(self.read_samples, index_of_file[chunks[i+1]], index_in_file[chunks[i+1]], filelist)
+            theta, x = self.get_batch_from_samples(index_of_file[chunk], index_in_file[chunk], filelist=filelist,
+                                                   multiplicity=self.multiplicity, samples=samples)
+            if not self.interleave_multiplicity:
+                yield theta, x
+            else:
+                # the copies of a waveform end up in different batches
+                theta, x = self.shuffle_batch(theta, x)
+                for j in range(0, len(theta), self.batch_size):
+                    yield theta[j:j+self.batch_size], x[j:j+self.batch_size]
+
+
+def block_shuffle_indices(Nfile, sample_per_file, window, rng):
+    '''
+    Sample order of an epoch as indices index_of_file*sample_per_file + index_in_file. Files are taken in random order, window at a time,
+    and the samples of those window files are shuffled together (so each file gets its own permutation). Only window files are in use 
+    at a time and each file is needed in one window only, so a cache of window files reads every file once per epoch.
+    '''
+    file_order = rng.permutation(Nfile)
+    order = []
+    for start in range(0, Nfile, window):
+        files = file_order[start:start+window]
+        order.append(rng.permutation((files[:, None] * sample_per_file + np.arange(sample_per_file)).reshape(-1)))
+    return np.concatenate(order)
+
+
+class BlockShuffleSampler(Sampler):
+    '''
+    Sampler for per-sample SVD datasets (DatasetSVDStrainFDFromSVDWFonGPU) that shuffles across window files at a time 
+    (block_shuffle_indices), close to IID order while every file is loaded once per epoch. 
+    Use DataLoader(dataset, sampler=BlockShuffleSampler(dataset, window), ...), with a dataset cache of at least window files.
+
+    hit_rate(): fraction of samples of the last epoch whose file is already in a LRU cache of max_files files (default window).
+    '''
+    def __init__(self, dataset, window=8, seed=None):
+        self.Nfile = dataset.Nfile
+        self.sample_per_file = dataset.sample_per_file
+        self.window = window
+        self.rng = np.random.default_rng(seed)
+        self.order = None
+        max_files = dataset.wf_cache.max_files
+        if max_files is not None and max_files < window:
+            print(f"Warning: waveform cache holds {max_files} files < window={window}, files will be loaded more than once.")
+
+    def __len__(self):
+        return self.Nfile * self.sample_per_file
+
+    def __iter__(self):
+        self.order = block_shuffle_indices(self.Nfile, self.sample_per_file, self.window, self.rng)
+        return iter(self.order.tolist())
+
+    def hit_rate(self, max_files=None):
+        if self.order is None:
+            return 0.
+        if max_files is None:
+            max_files = self.window
+        files = self.order // self.sample_per_file
+        # consecutive samples of the same file always hit
+        run_files = files[np.r_[0, np.flatnonzero(np.diff(files)) + 1]]
+        cache = OrderedDict()
+        misses = 0
+        for f in run_files.tolist():
+            if f in cache:
+                cache.move_to_end(f)
+            else:
+                misses += 1
+                cache[f] = None
+                if len(cache) > max_files:
+                    cache.popitem(last=False)
+        return 1 - misses / len(files)
+
+
+class DatasetFrozen(Dataset):
+    '''
+    A fixed realization of dataset (extrinsic parameters and noise drawn once with seed), stored as theta.npy and x.npy 
+    in cache_dir/frozen_<fingerprint> and read back memory-mapped. E.g. for validation, so that every epoch sees the same data 
+    without simulating it again.
+
+    The fingerprint hashes the basis, PSDs, frequency grid and weights, file list (names, sizes, modification times), dataset settings and seed,
+    so a change in any of them makes a new cache. Per-sample (DatasetSVDStrainFDFromSVDWFonGPU) and batch datasets are supported,
+    samples are stored one by one. The dataset is left as it was.
+    '''
+    # attributes of the dataset changed while it is materialized
+    DATASET_STATE = ['seed', '_rng', '_rng_pid', 'epoch_filelist', 'random_index_in_file', '_interleaved_block']
+
+    def __init__(self, dataset, cache_dir, seed=0, batch_size=1000, device='cpu'):
+        self.cache_dir = cache_dir
+        self.seed = seed
+        self.device = device
+        self.fingerprint = self.get_fingerprint(dataset, seed)
+        self.path = f"{cache_dir}/frozen_{self.fingerprint}"
+        if os.path.exists(self.path):
+            print(f"Loading frozen dataset from {self.path}")
+        else:
+            self.materialize(dataset, batch_size)
+        self.theta = np.load(f"{self.path}/theta.npy", mmap_mode='r')
+        self.x = np.load(f"{self.path}/x.npy", mmap_mode='r')
+
+    def get_fingerprint(self, dataset, seed):
+        sha = hashlib.sha1()
+        sha.update(torch.as_tensor(dataset.Vh).detach().cpu().numpy().tobytes())
+        for det in dataset.ifos:
+            sha.update(det.name.encode())
+            sha.update(np.asarray(dataset.data_generator.get_psd_masked(det)).tobytes())
+        sha.update(np.asarray(dataset.data_generator.frequency_weights).tobytes())
+        sha.update(dataset.farray.detach().cpu().numpy().tobytes())
+        for filename in dataset.precalwf_filelist:
+            sha.update(f"{os.path.abspath(filename)}:{os.path.getsize(filename)}:{os.path.getmtime(filename)}".encode())
+        settings = [type(dataset).__name__, dataset.parameter_names, dataset.Nbasis, dataset.complex, dataset.add_noise, 
+                    dataset.fix_extrinsic, dataset.dmin, dataset.dmax, dataset.dpower, seed]
+        sha.update(str(settings).encode())
+        return sha.hexdigest()[:16]
+
+    def materialize(self, dataset, batch_size):
+        print(f"Making frozen dataset {self.path}")
+        # the dataset is reseeded and reshuffled here, its state is put back afterwards so that the caller's stream is unchanged
+        saved_state = {key: dataset.__dict__[key] for key in self.DATASET_STATE if key in dataset.__dict__}
+        prefetcher = getattr(dataset, 'prefetcher', None)
+        if prefetcher is not None:
+            saved_order = prefetcher.order
+        try:
+            self.write(dataset, batch_size)
+        finally:
+            dataset.__dict__.update(saved_state)
+            if prefetcher is not None:
+                prefetcher.set_order(saved_order)
+
+    def write(self, dataset, batch_size):
+        dataset.seed = self.seed
+        dataset.init_worker(0)
+        dataset.shuffle_wflist()
+        dataset.shuffle_indexinfile()
+        tmp_path = self.path + f'.tmp{os.getpid()}'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        theta_mmap = None
+        n = 0
+        with torch.random.fork_rng():
+            torch.manual_seed(self.seed)
+            for theta, x in DataLoader(dataset, batch_size=batch_size, shuffle=False):
+                # batch datasets give [batch_size, minibatch_size, ...]
+                theta = theta.reshape(-1, theta.shape[-1]).cpu().numpy()
+                x = x.reshape(len(theta), *x.shape[-2:]).cpu().numpy()
+                if theta_mmap is None:
+                    Nsample = len(dataset) * len(theta) // min(batch_size, len(dataset))
+                    theta_mmap = np.lib.format.open_memmap(f"{tmp_path}/theta.npy", mode='w+', dtype=theta.dtype, shape=(Nsample,)+theta.shape[1:])
+                    x_mmap = np.lib.format.open_memmap(f"{tmp_path}/x.npy", mode='w+', dtype=x.dtype, shape=(Nsample,)+x.shape[1:])
+                theta_mmap[n:n+len(theta)] = theta
+                x_mmap[n:n+len(theta)] = x
+                n += len(theta)
+        theta_mmap.flush()
+        x_mmap.flush()
+        del theta_mmap, x_mmap
+        os.rename(tmp_path, self.path)
+        print(f"Frozen dataset saved to {self.path}, {n} samples.")
+
+    def __len__(self):
+        return len(self.theta)
+
+    def __getitem__(self, index):
+        theta = torch.from_numpy(np.array(self.theta[index])).to(self.device)
+        x = torch.from_numpy(np.array(self.x[index])).to(self.device)
+        return theta, x
+
+
+def worker_init_fn(worker_id):
+    '''
+    DataLoader(..., worker_init_fn=worker_init_fn) for the SVD datasets: seeds the worker's generator from the DataLoader worker seed
+    (different for every worker and epoch). Workers also do this by themselves on first use of dataset.rng.
+    '''
+    worker_info = get_worker_info()
+    worker_info.dataset.init_worker(worker_info.seed)
 
@@ -0,0 +1,281 @@
+import numpy as np
+import h5py
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LazyH5File():
+    '''
+    Read-only, dict-like view of a HDF5 file (same layout as load_dict_from_hdf5) that reads only the rows asked for.
+
+    The h5py handle is opened on first access and reopened in a new process, so the object can be shared
+    with DataLoader workers. wf['waveform_polarizations']['plus']['amplitude'][index] reads only rows index.
+    timer: optional WaveformFilePrefetcher, the time spent reading rows is added to its io_wait_time (see add_io_time).
+    '''
+    def __init__(self, filename, timer=None):
+        self.filename = filename
+        self.timer = timer
+        self._h5file = None
+        self._pid = None
+
+    @property
+    def h5file(self):
+        if self._h5file is None or self._pid != os.getpid():
+            self._h5file = h5py.File(self.filename, 'r')
+            self._pid = os.getpid()
+        return self._h5file
+
+    def __getitem__(self, key):
+        return LazyH5Group(self, '')[key]
+
+    def __contains__(self, key):
+        return key in self.h5file
+
+    def close(self):
+        if self._h5file is not None and self._pid == os.getpid():
+            self._h5file.close()
+        self._h5file = None
+
+    def __getstate__(self):
+        # h5py handles can not be pickled, workers open their own
+        state = self.__dict__.copy()
+        state['_h5file'] = None
+        state['_pid'] = None
+        return state
+
+
+class LazyH5Group():
+    def __init__(self, lazyfile, path):
+        self.lazyfile = lazyfile
+        self.path = path
+
+    def __getitem__(self, key):
+        path = f'{self.path}/{key}' if self.path else key
+        item = self.lazyfile.h5file[path]
+        if isinstance(item, h5py.Group):
+            return LazyH5Group(self.lazyfile, path)
+        return LazyH5Dataset(self.lazyfile, path)
+
+    def __contains__(self, key):
+        return key in self.lazyfile.h5file[self.path or '/']
+
+    def keys(self):
+        return self.lazyfile.h5file[self.path or '/'].keys()
+
+
+class LazyH5Dataset():
+    def __init__(self, lazyfile, path):
+        self.lazyfile = lazyfile
+        self.path = path
+
+    def __len__(self):
+        return len(self.lazyfile.h5file[self.path])
+
+    @property
+    def shape(self):
+        return self.lazyfile.h5file[self.path].shape
+
+    def __getitem__(self, index):
+        t0 = time.time()
+        rows = read_rows(self.lazyfile.h5file[self.path], index)
+        if self.lazyfile.timer is not None:
+            self.lazyfile.timer.add_io_time(time.time() - t0)
+        return rows
+
+
+def read_rows(dset, index):
+    '''
+    dset[index] for integers, slices and (shuffled) integer arrays.
+    h5py needs increasing indices, so arrays are read sorted (as one slice if they are contiguous) and put back in order.
+    '''
+    if isinstance(index, (slice, int, np.integer)) or index is Ellipsis or (isinstance(index, tuple) and len(index) == 0):
+        return dset[index]
+    index = np.asarray(index)
+    if index.ndim == 0:
+        return dset[int(index)]
+    if len(index) == 0:
+        return np.empty((0,) + dset.shape[1:], dtype=dset.dtype)
+    unique_index, inverse = np.unique(index, return_inverse=True)
+    if unique_index[-1] - unique_index[0] + 1 == len(unique_index):
+        rows = dset[unique_index[0]:unique_index[-1]+1]
+    else:
+        rows = dset[unique_index]
+    return rows[inverse]
+
+
+class WaveformFileCache():
+    '''
+    LRU cache of loaded waveform files keyed by filename, bounded by max_bytes (sum of array sizes) and optionally max_files.
+    The most recent file is always kept, so max_bytes=0 caches exactly one loaded file. Evicted files are closed if they have close().
+    max_bytes only applies to files loaded into memory (load_dict_from_hdf5): a LazyH5File holds no data and counts 0 bytes,
+    so a cache of lazy files is bounded by max_files only (and caches open handles, not decoded rows).
+    hits, misses and evictions count cache accesses, see stats().
+    '''
+    def __init__(self, loader, max_bytes=0, max_files=None):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.files = OrderedDict()
+        self.nbytes = 0
+        self.reset_stats()
+
+    def get(self, filename):
+        if filename in self.files:
+            self.files.move_to_end(filename)
+            self.hits += 1
+            return self.files[filename][0]
+
+        self.misses += 1
+        item = self.loader(filename)
+        self.put(filename, item)
+        return item
+
+    def put(self, filename, item):
+        '''
+        Insert an item loaded elsewhere (e.g. by WaveformFilePrefetcher).
+        '''
+        if filename in self.files:
+            self.nbytes -= self.files.pop(filename)[1]
+        nbytes = get_nbytes(item)
+        self.files[filename] = (item, nbytes)
+        self.nbytes += nbytes
+        while len(self.files) > 1 and (self.nbytes > self.max_bytes or 
+                                       (self.max_files is not None and len(self.files) > self.max_files)):
+            self.evict()
+
+    def evict(self):
+        _, (item, nbytes) = self.files.popitem(last=False)
+        self.nbytes -= nbytes
+        self.evictions += 1
+        if hasattr(item, 'close'):
+            item.close()
+
+    def clear(self):
+        while self.files:
+            self.evict()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        # loaded files are not sent to DataLoader workers, they load their own
+        state = self.__dict__.copy()
+        state['files'] = OrderedDict()
+        state['nbytes'] = 0
+        return state
+
+    def stats(self):
+        naccess = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 
+                'hit_rate': self.hits / naccess if naccess else 0., 'nfiles': len(self.files), 'nbytes': self.nbytes}
+
+
+def get_nbytes(item):
+    '''
+    Bytes held by arrays in a nested dict. Lazy files hold nothing.
+    '''
+    if isinstance(item, dict):
+        return sum(get_nbytes(value) for value in item.values())
+    return item.nbytes if isinstance(item, np.ndarray) else 0
+
+
+class WaveformFilePrefetcher():
+    '''
+    Load the next depth files of the epoch's file order (set_order) in a background thread, while the current one is used.
+    Files are put into cache when they are asked for by get. Only useful if the loader reads the data (load_dict_from_hdf5):
+    opening a LazyH5File reads nothing, so for lazy files use depth=0 and read the rows ahead instead, with submit/result
+    (e.g. DatasetSVDStrainFDFromSVDWFonGPUIterable), passing the prefetcher as the timer of the lazy files.
+
+    io_wait_time: seconds spent waiting for data (in get, result, or reading lazy rows) since the last set_order, 
+    time spent in the background thread is not counted. epoch_io_wait_times: io_wait_time of previous epochs.
+    '''
+    def __init__(self, cache, depth=2):
+        self.cache = cache
+        self.depth = depth
+        self.order = []
+        self.position = {}
+        self.pending = {}
+        self.prefetch_hits = 0
+        self.io_wait_time = 0.
+        self.epoch_io_wait_times = []
+        self._executor = None
+        self._pid = None
+        self._thread_id = None
+
+    @property
+    def executor(self):
+        # threads do not survive fork, DataLoader workers start their own
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=1, initializer=self.set_thread_id)
+            self._pid = os.getpid()
+            self.pending = {}
+        return self._executor
+
+    def set_thread_id(self):
+        self._thread_id = threading.get_ident()
+
+    def add_io_time(self, seconds):
+        # reads in the background thread overlap with the work of the caller, they are not waited for
+        if threading.get_ident() != self._thread_id:
+            self.io_wait_time += seconds
+
+    def submit(self, fn, *args):
+        '''
+        Run fn(*args) in the background thread, e.g. to read the rows of the next batch. Get the output with result.
+        '''
+        return self.executor.submit(fn, *args)
+
+    def result(self, future):
+        t0 = time.time()
+        output = future.result()
+        self.add_io_time(time.time() - t0)
+        return output
+
+    def set_order(self, filelist):
+        if self.order:
+            self.epoch_io_wait_times.append(self.io_wait_time)
+        self.io_wait_time = 0.
+        self.prefetch_hits = 0
+        self.order = list(filelist)
+        self.position = {filename: i for i, filename in enumerate(self.order)}
+        self.schedule(self.order[:self.depth])
+
+    def get(self, filename):
+        executor = self.executor
+        t0 = time.time()
+        if filename in self.cache.files:
+            item = self.cache.get(filename)
+        elif filename in self.pending:
+            item = self.pending.pop(filename).result()
+            self.cache.put(filename, item)
+            self.prefetch_hits += 1
+        else:
+            item = self.cache.get(filename)
+        self.add_io_time(time.time() - t0)
+
+        i = self.position.get(filename)
+        if i is not None:
+            self.schedule(self.order[i+1:i+1+self.depth])
+        return item
+
+    def schedule(self, filelist):
+        executor = self.executor
+        for filename in filelist:
+            if filename not in self.cache.files and filename not in self.pending:
+                self.pending[filename] = executor.submit(self.cache.loader, filename)
+
+    def stats(self):
+        return {'io_wait_time': self.io_wait_time, 'prefetch_hits': self.prefetch_hits, **self.cache.stats()}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_pid'] = None
+        state['_thread_id'] = None
+        state['pending'] = {}
+        return state
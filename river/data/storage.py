@@ -0,0 +1,198 @@
+import numpy as np
+import h5py
+import tempfile
+
+
+class MemoryBudget():
+    '''
+    Bytes held in RAM by a group of GrowableArrays. An array that would take the group above max_bytes is moved to a file in spill_dir.
+    max_bytes=None means no limit.
+    '''
+    def __init__(self, max_bytes=None, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.nbytes = 0
+
+    def request(self, nbytes):
+        if self.max_bytes is not None and self.nbytes + nbytes > self.max_bytes:
+            return False
+        self.nbytes += nbytes
+        return True
+
+    def release(self, nbytes):
+        self.nbytes -= nbytes
+
+
+class GrowableArray():
+    '''
+    Preallocated array that grows by doubling, a replacement of the python lists used to collect generated data.
+    Rows are stored in one contiguous block, view() returns the filled part without copying.
+    '''
+    def __init__(self, dtype=None, budget=None, initial_capacity=16):
+        self.dtype = dtype
+        self.budget = budget
+        self.initial_capacity = initial_capacity
+        self.spilled = False
+        self._buffer = None
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, index):
+        return self.view()[index]
+
+    def __iter__(self):
+        return iter(self.view())
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.view()
+        return self.view().astype(dtype)
+
+    @property
+    def shape(self):
+        return self.view().shape
+
+    @property
+    def nbytes(self):
+        return 0 if self._buffer is None else self._buffer.nbytes
+
+    def append(self, row):
+        row = np.asarray(row, dtype=self.dtype)
+        self.extend(row[None])
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=self.dtype)
+        if len(rows) == 0:
+            return
+        if self._buffer is None:
+            if self.dtype is None:
+                self.dtype = rows.dtype
+            self._allocate(max(self.initial_capacity, len(rows)), rows.shape[1:])
+        elif self._n + len(rows) > len(self._buffer):
+            self._allocate(max(2*len(self._buffer), self._n + len(rows)), self._buffer.shape[1:])
+        self._buffer[self._n:self._n+len(rows)] = rows
+        self._n += len(rows)
+
+    def view(self):
+        if self._buffer is None:
+            return np.empty(0, dtype=self.dtype)
+        return self._buffer[:self._n]
+
+    def clear(self):
+        if self._buffer is not None and not self.spilled and self.budget is not None:
+            self.budget.release(self._buffer.nbytes)
+        self._buffer = None
+        self._n = 0
+        self.spilled = False
+
+    def _allocate(self, capacity, row_shape):
+        shape = (capacity,) + tuple(row_shape)
+        nbytes = int(np.prod(shape)) * np.dtype(self.dtype).itemsize
+        old_buffer = self._buffer
+        if self.spilled or (self.budget is not None and not self.budget.request(nbytes)):
+            spill_dir = None if self.budget is None else self.budget.spill_dir
+            # the file is removed once the memmap is garbage collected
+            new_buffer = np.memmap(tempfile.TemporaryFile(dir=spill_dir), dtype=self.dtype, mode='w+', shape=shape)
+            if not self.spilled and old_buffer is not None and self.budget is not None:
+                self.budget.release(old_buffer.nbytes)
+            self.spilled = True
+        else:
+            new_buffer = np.empty(shape, dtype=self.dtype)
+            if old_buffer is not None and self.budget is not None:
+                self.budget.release(old_buffer.nbytes)
+        if old_buffer is not None:
+            new_buffer[:self._n] = old_buffer[:self._n]
+        self._buffer = new_buffer
+
+
+class HDF5StreamWriter():
+    '''
+    Append nested dicts of arrays (same layout as save_dict_to_hdf5) to resizable, chunked datasets, so that a bank can be 
+    written while it is generated. Opening an existing file continues after the rows already in it.
+    '''
+    def __init__(self, filename, flush_every=1, chunk_bytes=2**20):
+        self.filename = filename
+        self.flush_every = flush_every
+        self.chunk_bytes = chunk_bytes
+        self.h5file = h5py.File(filename, 'a')
+        self.attrs = self.h5file.attrs
+        self.nappend = 0
+
+        # rows appended to some datasets but not all of them (e.g. killed during append) are dropped
+        self.stream_paths = []
+        self.h5file.visititems(self._find_stream_datasets)
+        if self.stream_paths:
+            nrows = self.nrows
+            for path in self.stream_paths:
+                self.h5file[path].resize(nrows, axis=0)
+
+    def _find_stream_datasets(self, name, item):
+        if isinstance(item, h5py.Dataset) and item.maxshape[0] is None:
+            self.stream_paths.append(name)
+
+    @property
+    def nrows(self):
+        if not self.stream_paths:
+            return 0
+        return min(len(self.h5file[path]) for path in self.stream_paths)
+
+    def append(self, dic):
+        '''
+        Append rows. All arrays in dic should have the same length.
+        '''
+        for path, rows in flatten_dict(dic).items():
+            rows = np.asarray(rows)
+            if len(rows) == 0:
+                continue
+            if path not in self.h5file:
+                row_shape = rows.shape[1:]
+                row_nbytes = max(1, int(np.prod(row_shape)) * rows.dtype.itemsize)
+                chunk_rows = max(1, self.chunk_bytes // row_nbytes)
+                self.h5file.create_dataset(path, shape=(0,)+row_shape, maxshape=(None,)+row_shape,
+                                           chunks=(chunk_rows,)+row_shape, dtype=rows.dtype)
+                self.stream_paths.append(path)
+            dset = self.h5file[path]
+            n = len(dset)
+            dset.resize(n + len(rows), axis=0)
+            dset[n:] = rows
+
+        self.nappend += 1
+        if self.nappend % self.flush_every == 0:
+            self.flush()
+
+    def write(self, dic):
+        '''
+        Write (or overwrite) datasets that are not appended, e.g. farray or Nsample.
+        '''
+        for path, item in flatten_dict(dic).items():
+            item = np.asarray(item)
+            if path in self.h5file and self.h5file[path].shape == item.shape:
+                self.h5file[path][...] = item
+            else:
+                if path in self.h5file:
+                    del self.h5file[path]
+                self.h5file[path] = item
+
+    def flush(self):
+        self.h5file.flush()
+
+    def close(self):
+        self.h5file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def flatten_dict(dic, path=''):
+    flat = {}
+    for key, item in dic.items():
+        if isinstance(item, dict):
+            flat.update(flatten_dict(item, path + key + '/'))
+        else:
+            flat[path + key] = item
+    return flat
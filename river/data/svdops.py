@@ -0,0 +1,247 @@
+import numpy as np
+import torch
+import hashlib
+import os
+from math import factorial
+
+'''
+Operators acting directly in SVD space, so that training data can be simulated without going back to the frequency grid.
+'''
+
+class SVDTimeShiftOperator():
+    '''
+    Time shift in SVD space, M(dt) = Vh diag(exp(-2 pi i f dt)) whitened_V, an [Nbasis, Nbasis] matrix for each detector.
+
+    M is tabulated on nodes dt_k spaced by dt_step in [dt_min, dt_max]. Between nodes it is expanded in delta = dt - dt_k,
+    exp(-2 pi i f delta) = exp(-2 pi i fc delta) sum_n (-2 pi i fw delta)^n / n! u^n, with u = (f - fc)/fw in [-1, 1],
+    so the table holds Vh diag(u^n exp(-2 pi i f dt_k)) whitened_V for n <= order, and applying a shift costs
+    (order+1)*Nbasis^2 per sample instead of 2*Nbasis*Nfreq.
+    If dt_step is None it is chosen so that the truncation error of the expansion is below tolerance. If order is None it is 
+    the one giving the smallest table for tolerance (or the lowest one reaching tolerance for a given dt_step), up to MAX_ORDER.
+    The table takes Ndet*Nnode*(order+1)*Nbasis^2*8 bytes, a ValueError is raised above max_bytes.
+
+    The table is saved to cache_dir, keyed by a hash of the bases, frequencies and grid, and loaded from there next time.
+    '''
+    MAX_ORDER = 16
+    # largest 2 pi fw delta of the expansion, terms up to e^3 keep the float32 cancellation error small
+    MAX_EXPANSION_ARGUMENT = 3.
+
+    def __init__(self, Vh, whitened_V_list, farray, dt_min, dt_max, order=None, tolerance=1e-5, dt_step=None,
+                 max_bytes=2**34, cache_dir=None, device='cpu'):
+        self.device = device
+        farray = torch.as_tensor(farray, dtype=torch.float64)
+        self.fc = float(farray.max() + farray.min()) / 2
+        self.fw = float(farray.max() - farray.min()) / 2
+        if order is None and dt_step is None:
+            # nodes scale as 1/dt_step, table size as (order+1)/dt_step
+            order = min(range(1, self.MAX_ORDER+1), key=lambda n: (n+1) / self.get_dt_step(n, tolerance))
+        elif order is None:
+            x = np.pi * self.fw * dt_step
+            order = next((n for n in range(1, self.MAX_ORDER+1) if x**(n+1) / factorial(n+1) < tolerance), self.MAX_ORDER)
+        if dt_step is None:
+            dt_step = self.get_dt_step(order, tolerance)
+        self.order = order
+        self.dt_step = dt_step
+        self.dt_min = dt_min
+        self.Nnode = int(np.ceil((dt_max - dt_min) / dt_step)) + 1
+        self.nodes = dt_min + dt_step * torch.arange(self.Nnode, dtype=torch.float64)
+
+        Ndet = len(whitened_V_list)
+        Nbasis = Vh.shape[0]
+        nbytes = Ndet * self.Nnode * (order+1) * Nbasis**2 * 8
+        if nbytes > max_bytes:
+            raise ValueError(f"Time shift table needs {nbytes/2**30:.2f} GB ({self.Nnode} nodes, order {order}) > "
+                             f"max_bytes={max_bytes/2**30:.2f} GB, use a larger max_bytes, smaller dt range, larger tolerance or fewer basis!")
+
+        cache_path = None
+        if cache_dir is not None:
+            key = self.get_cache_key(Vh, whitened_V_list, farray, dt_max)
+            cache_path = f"{cache_dir}/timeshift_{key}.pt"
+        if cache_path is not None and os.path.exists(cache_path):
+            self.table = torch.load(cache_path, map_location=device)
+            print(f"Loaded time shift table from {cache_path}")
+        else:
+            self.table = self.build_table(Vh, whitened_V_list, farray)
+            if cache_path is not None:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                torch.save(self.table.cpu(), cache_path + '.tmp')
+                os.replace(cache_path + '.tmp', cache_path)
+                print(f"Time shift table saved to {cache_path}")
+
+    def get_dt_step(self, order, tolerance):
+        # |x|^(order+1)/(order+1)! < tolerance with x = 2 pi fw delta and |delta| <= dt_step/2
+        x_max = min((tolerance * factorial(order+1))**(1/(order+1)), self.MAX_EXPANSION_ARGUMENT)
+        return 2 * x_max / (2 * np.pi * self.fw)
+
+    def get_cache_key(self, Vh, whitened_V_list, farray, dt_max):
+        sha = hashlib.sha1()
+        for array in [Vh] + list(whitened_V_list) + [farray]:
+            sha.update(torch.as_tensor(array).detach().cpu().numpy().tobytes())
+        sha.update(np.array([self.dt_min, dt_max, self.dt_step, self.order]).tobytes())
+        return sha.hexdigest()[:16]
+
+    def build_table(self, Vh, whitened_V_list, farray):
+        '''
+        table: [Ndet, Nnode, order+1, Nbasis, Nbasis] complex64
+        '''
+        Vh = torch.as_tensor(Vh).to(self.device).type(torch.complex128)
+        farray = farray.to(self.device)
+        u = (farray - self.fc) / self.fw
+        Nbasis = Vh.shape[0]
+        table = torch.zeros((len(whitened_V_list), self.Nnode, self.order+1, Nbasis, Nbasis), dtype=torch.complex64, device=self.device)
+        for i, whitened_V in enumerate(whitened_V_list):
+            whitened_V = torch.as_tensor(whitened_V).to(self.device).type(torch.complex128)
+            for k in range(self.Nnode):
+                weights = torch.exp(-1j * 2 * np.pi * farray * self.nodes[k])
+                for n in range(self.order+1):
+                    table[i,k,n] = ((Vh * weights) @ whitened_V).type(torch.complex64)
+                    weights = weights * u
+        return table
+
+    def apply_all(self, h, dt):
+        '''
+        h: [N, Ndet, Nbasis], dt: [N, Ndet]. All detectors at once, returns [N, Ndet, Nbasis].
+        '''
+        N, Ndet, Nbasis = h.shape
+        dt = torch.as_tensor(dt, dtype=torch.float64, device=self.device)
+        coefficients, k = self.get_expansion(dt)  # [N, Ndet, order+1], [N, Ndet]
+        idet = torch.arange(Ndet, device=self.device).expand(N, Ndet)
+        return self.apply_grouped(h.reshape(N*Ndet, Nbasis), coefficients.reshape(N*Ndet, -1), 
+                                  idet.reshape(-1), k.reshape(-1)).reshape(N, Ndet, Nbasis)
+
+    def get_expansion(self, dt):
+        '''
+        Expansion coefficients [..., order+1] and node indices of time shifts dt.
+        '''
+        k = torch.clamp(torch.round((dt - self.dt_min) / self.dt_step).long(), 0, self.Nnode-1)
+        delta = dt - (self.dt_min + self.dt_step * k)
+        n = torch.arange(self.order+1, device=self.device)
+        inverse_factorial = torch.tensor([1/factorial(i) for i in range(self.order+1)], dtype=torch.float64, device=self.device)
+        coefficients = (-1j * 2 * np.pi * self.fw * delta.unsqueeze(-1))**n * inverse_factorial * \
+                        torch.exp(-1j * 2 * np.pi * self.fc * delta).unsqueeze(-1)
+        return coefficients, k
+
+    def apply(self, h, dt, idet):
+        '''
+        h: [N, Nbasis] SVD coefficients, dt: [N] time shifts. Returns h @ M(dt) of detector idet, [N, Nbasis].
+        '''
+        dt = torch.as_tensor(dt, dtype=torch.float64, device=self.device)
+        coefficients, k = self.get_expansion(dt)  # [N, order+1], [N]
+        return self.apply_grouped(h, coefficients, torch.full_like(k, idet), k)
+
+    def apply_grouped(self, h, coefficients, idet, k):
+        '''
+        h: [M, Nbasis], coefficients: [M, order+1], idet, k: [M]. Rows are grouped by (detector, node), and each group is 
+        multiplied by its table entry in one batched matmul, instead of gathering a copy of the table for every row.
+        '''
+        key = idet * self.Nnode + k
+        key_sorted, order = torch.sort(key)
+        keys, counts = torch.unique_consecutive(key_sorted, return_counts=True)
+        coefficients = coefficients.type(torch.complex64)
+        out = torch.empty_like(h)
+        start = 0
+        for key_group, count in zip(keys.tolist(), counts.tolist()):
+            rows = order[start:start+count]
+            start += count
+            T = self.table[key_group // self.Nnode, key_group % self.Nnode]  # [order+1, Nbasis, Nbasis]
+            # sum_n c_n h @ T_n
+            y = torch.matmul(h[rows].unsqueeze(0), T)  # [order+1, count, Nbasis]
+            out[rows] = (coefficients[rows].T.unsqueeze(-1) * y).sum(0)
+        return out
+
+
+class FusedStrainSimulator():
+    '''
+    Whitened SVD strains of all detectors in one go: projection, time shifts and noise are batched over (sample, detector, basis)
+    instead of looping over detectors.
+
+    whitened_V_list: whitened V of each detector (or a [Ndet, Nfreq, Nbasis] tensor), stacked to [Ndet, Nfreq, Nbasis].
+    timeshift_operator: optional SVDTimeShiftOperator, time shifts are then done in SVD space.
+    reuse_output: write the output into the same preallocated buffer at every call. Only safe if the caller copies the output 
+    (e.g. torch.cat) before the next call.
+    chunk_size: without timeshift_operator, samples go through the frequency domain chunk_size at a time, in buffers of 
+    BYTES_PER_FREQUENCY*Ndet*chunk_size*Nfreq bytes, so memory does not grow with the batch size (see get_chunk_size).
+    '''
+    # hf (complex64), fractional cycles (float64), phase angle (float32) and phase (complex64)
+    BYTES_PER_FREQUENCY = 28
+
+    def __init__(self, Vh, whitened_V_list, farray, timeshift_operator=None, reuse_output=True, chunk_size=256, device='cpu'):
+        self.device = device
+        self.Vh = torch.as_tensor(Vh).to(device).type(torch.complex64)
+        if isinstance(whitened_V_list, torch.Tensor):
+            # already stacked, e.g. from BasisStore.get_whitened_V, no copy
+            self.whitened_V = whitened_V_list.to(device).type(torch.complex64)
+        else:
+            self.whitened_V = torch.stack([torch.as_tensor(V).to(device).type(torch.complex64) for V in whitened_V_list])
+        self.farray = torch.as_tensor(farray, dtype=torch.float64).to(device)
+        self.timeshift_operator = timeshift_operator
+        self.reuse_output = reuse_output
+        self.chunk_size = chunk_size
+        self.one = torch.ones((), dtype=torch.float32, device=device)
+        self.buffers = {}
+
+    @classmethod
+    def get_chunk_size(cls, Ndet, Nfreq, max_bytes):
+        '''
+        Largest chunk_size whose buffers fit in max_bytes.
+        '''
+        return max(1, int(max_bytes // (cls.BYTES_PER_FREQUENCY * Ndet * Nfreq)))
+
+    def get_buffer(self, name, shape, dtype=torch.complex64):
+        '''
+        A tensor of shape, the start of a flat buffer that only grows, so smaller (e.g. last) chunks do not reallocate.
+        '''
+        numel = int(np.prod(shape))
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.dtype != dtype or buffer.numel() < numel:
+            buffer = torch.empty(numel, dtype=dtype, device=self.device)
+            self.buffers[name] = buffer
+        return buffer[:numel].view(shape)
+
+    def get_phase(self, dt):
+        '''
+        exp(-2 pi i f dt) for dt [n, Ndet], a [Ndet, n, Nfreq] complex64 buffer.
+        '''
+        shape = (dt.shape[1], dt.shape[0], len(self.farray))
+        cycles = self.get_buffer('cycles', shape, torch.float64)
+        torch.mul(dt.T.unsqueeze(-1).type(torch.float64), self.farray, out=cycles)
+        # only the fractional part of f*dt matters, which float32 holds to ~1e-7 cycles
+        cycles.frac_()
+        angle = self.get_buffer('angle', shape, torch.float32)
+        angle.copy_(cycles).mul_(-2 * np.pi)
+        phase = self.get_buffer('phase', shape)
+        torch.polar(self.one.expand(shape), angle, out=phase)
+        return phase
+
+    def __call__(self, hp, hc, fp, fc, dt, add_noise=True):
+        '''
+        hp, hc: [N, Nbasis] SVD coefficients (already scaled by distance). fp, fc, dt: [N, Ndet].
+        Returns x [N, Ndet, Nbasis].
+        '''
+        N, Nbasis = hp.shape
+        Ndet = self.whitened_V.shape[0]
+        if self.reuse_output:
+            out = self.get_buffer('out', (N, Ndet, Nbasis))
+        else:
+            out = torch.empty((N, Ndet, Nbasis), dtype=torch.complex64, device=self.device)
+
+        if self.timeshift_operator is not None:
+            # no frequency-domain buffers, all samples at once
+            hh = (fp.unsqueeze(-1) * hp.unsqueeze(1) + fc.unsqueeze(-1) * hc.unsqueeze(1)).type(torch.complex64)  # [N, Ndet, Nbasis]
+            out.copy_(self.timeshift_operator.apply_all(hh, dt))
+        else:
+            for start in range(0, N, self.chunk_size):
+                chunk = slice(start, min(start + self.chunk_size, N))
+                hh = (fp[chunk].unsqueeze(-1) * hp[chunk].unsqueeze(1) + 
+                      fc[chunk].unsqueeze(-1) * hc[chunk].unsqueeze(1)).type(torch.complex64)  # [n, Ndet, Nbasis]
+                hf = self.get_buffer('hf', (Ndet, len(hh), len(self.farray)))
+                torch.matmul(hh.transpose(0, 1), self.Vh, out=hf)
+                hf.mul_(self.get_phase(dt[chunk]))
+                out[chunk] = torch.matmul(hf, self.whitened_V).transpose(0, 1)
+
+        if add_noise:
+            # real and imaginary parts ~ N(0, 1), one RNG call for all detectors
+            out.add_(torch.view_as_complex(torch.randn((N, Ndet, Nbasis, 2), device=self.device)))
+
+        return out
@@ -1,6 +1,9 @@
 import numpy as np
 import h5py 
 import bilby
+import json
+import os
+from .storage import GrowableArray
 
 #PARAMETER_NAMES_PRECESSINGBNS_BILBY = ['mass_1', 'mass_2', 'a_1', 'a_2', 'tilt_1', 'tilt_2', 'phi_12', 'phi_jl', 'lambda_1', 'lambda_2', 'theta_jn', 'luminosity_distance', 'ra', 'dec', 'psi', 'phase', 'geocent_time' ]
 PARAMETER_NAMES_ALL_PRECESSINGBNS_BILBY = ['mass_1', 'mass_2', 'chirp_mass', 'mass_ratio', 'a_1', 'a_2', 'tilt_1', 'tilt_2', 'phi_12', 'phi_jl', 'lambda_1', 'lambda_2', 'lambda_tilde', 'delta_lambda_tilde', 'theta_jn', 'luminosity_distance', 'ra', 'dec', 'psi', 'phase', 'geocent_time' ]
@@ -15,6 +18,8 @@ def save_dict_to_hdf5(dic, filename):
 
 def recursively_save_dict_contents_to_group(h5file, path, dic):
     for key, item in dic.items():
+        if isinstance(item, GrowableArray):
+            item = item.view()
         if isinstance(item, (np.ndarray, np.int64, np.float64, str, bytes, list)):
             h5file[path + key] = item
         elif isinstance(item, dict):
@@ -35,8 +40,83 @@ def recursively_load_dict_contents_from_group(h5file, path):
             ans[key] = recursively_load_dict_contents_from_group(h5file, path + key + '/')
     return ans
 
+def load_manifest(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        return json.load(f)
 
+def save_manifest(manifest, filename):
+    # write then rename, so that the manifest is never half-written
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmpname, filename)
 
+def convert_svd_waveforms_to_complex(filename, outfilename=None, dtype=np.complex64):
+    '''
+    Convert a SVD waveform file with 'amplitude' and 'phase' to complex 'coefficients' (svd_storage='complex').
+    Overwrites filename if outfilename is None.
+    '''
+    wf_dict = load_dict_from_hdf5(filename)
+    for mode, waveform_component in wf_dict['waveform_polarizations'].items():
+        if 'coefficients' in waveform_component:
+            continue
+        coefficients = (waveform_component['amplitude'] * np.exp(1j * waveform_component['phase'])).astype(dtype)
+        wf_dict['waveform_polarizations'][mode] = {'coefficients': coefficients}
+    if outfilename is None:
+        outfilename = filename
+    tmpname = outfilename + '.tmp'
+    save_dict_to_hdf5(wf_dict, tmpname)
+    os.replace(tmpname, outfilename)
+
+##################### frequency grids #####################
+def chirp_time(frequency, chirp_mass):
+    '''
+    Leading order time to merger from frequency (Hz), chirp_mass in solar mass.
+    '''
+    chirp_mass_s = chirp_mass * bilby.core.utils.solar_mass * bilby.core.utils.gravitational_constant / bilby.core.utils.speed_of_light**3
+    return 5 / 256 * (np.pi * frequency)**(-8/3) * chirp_mass_s**(-5/3)
+
+def get_multibanded_frequency_array(f_low, f_high, duration, chirp_mass_min, safety=4, time_margin=1):
+    '''
+    Frequency grid with spacing 2^b/duration in band b. The spacing is doubled once safety * chirp_time(f) + time_margin of
+    the lightest signal fits into duration/2^(b+1), so the signal (shifted by up to time_margin) is resolved in every band.
+    safety > 2 keeps the phase change between neighbouring points below pi, so that the phase can be unwrapped.
+    All points lie on the uniform grid of duration, from the first uniform point >= f_low to the last one <= f_high.
+
+    Returns the frequencies and their weights, the number of uniform bins each point stands for (sum of weights = number of uniform bins).
+    '''
+    df = 1 / duration
+    k_low = int(np.ceil(f_low * duration - 1e-8))
+    k_high = int(np.floor(f_high * duration + 1e-8))
+
+    chirp_mass_s = chirp_mass_min * bilby.core.utils.solar_mass * bilby.core.utils.gravitational_constant / bilby.core.utils.speed_of_light**3
+    indices = []
+    k = k_low
+    b = 0
+    while k <= k_high:
+        tau_max = (duration / 2**(b+1) - time_margin) / safety
+        if tau_max > 0:
+            # frequency above which the band b+1 spacing is fine enough, inverse of chirp_time
+            f_switch = (256 / 5 * tau_max * chirp_mass_s**(5/3))**(-3/8) / np.pi
+            k_switch = min(k_high + 1, int(np.ceil(f_switch * duration)))
+        else:
+            k_switch = k_high + 1
+        step = 2**b
+        n = max(0, int(np.ceil((k_switch - k) / step)))
+        indices.append(k + step * np.arange(n))
+        k += step * n
+        b += 1
+    indices = np.concatenate(indices)
+    if indices[-1] != k_high:
+        indices = np.append(indices, k_high)
+
+    # trapezoidal rule for the sum over uniform bins
+    gaps = np.diff(indices).astype(float)
+    weights = np.append(gaps, 0) / 2 + np.append(0, gaps) / 2
+    weights[[0, -1]] += 0.5
+    return indices * df, weights
 
 ##################### source parameters #####################
 
@@ -66,14 +146,18 @@ def generate_random_twospins_bilbystyle(Nsample, a_max=0.99):
     return a_1, a_2, tilt_1, tilt_2, phi_12, phi_jl
 
 
-def generate_random_distance(Nsample, low, high, power=3):
+def generate_random_distance(Nsample, low, high, power=3, rng=None):
     '''
     PDF propto power-1. 
 
     Power=3 -> uniform in volume
     Power=1 -> uniform in distance
+
+    rng: numpy Generator, default np.random
     '''
-    dl = (high - low) * np.random.power(a=power, size=Nsample) + low
+    if rng is None:
+        rng = np.random
+    dl = (high - low) * rng.power(a=power, size=Nsample) + low
     return dl
 
 def generate_random_extrinsic_angles(Nsample):
@@ -1,6 +1,10 @@
 from sklearn.decomposition import IncrementalPCA
 import numpy as np
 import torch
+import h5py
+import pickle
+import os
+from concurrent.futures import ProcessPoolExecutor
 
 
 
@@ -40,6 +44,25 @@ class IPCAGenerator():
                 self.pca_dict[detname]['realimag'].partial_fit(np.real(strain_template_dict[detname]))
                 self.pca_dict[detname]['realimag'].partial_fit(np.imag(strain_template_dict[detname]))
 
+    def fit_from_files(self, filelist, batch_size=1000, nproc=None, checkpoint_dir=None, checkpoint_every=10):
+        '''
+        Streamed version of fit. Templates are read from HDF5 files in batches of batch_size (see iterate_template_batches), 
+        the independent IPCA of each (detname, part) is fitted in its own process. 
+        If checkpoint_dir is given, models are saved every checkpoint_every batches and a new call continues from there.
+        '''
+        if checkpoint_dir is not None and not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        tasks = [(detname, part) for detname in self.detector_names for part in self.pca_dict[detname].keys()]
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            futures = {}
+            for detname, part in tasks:
+                checkpoint_path = None if checkpoint_dir is None else f"{checkpoint_dir}/ipca_{detname}_{part}.pkl"
+                futures[(detname, part)] = executor.submit(fit_ipca_streamed, self.pca_dict[detname][part], filelist, [detname], part,
+                                                           self.decomposition, batch_size, checkpoint_path, checkpoint_every)
+            for (detname, part), future in futures.items():
+                self.pca_dict[detname][part] = future.result()
+                print(f"IPCA for {detname} {part} done")
+
     def project(self, strain, detname, part):
         pca = self.pca_dict[detname][part]
         #proj = pca.transform(strain)
@@ -68,8 +91,109 @@ class IPCAGeneratorFDWFRL():
             self.ipca.partial_fit(np.real(h))
             self.ipca.partial_fit(np.imag(h))
 
+    def fit_from_files(self, filelist, batch_size=1000, checkpoint_dir=None, checkpoint_every=10):
+        '''
+        Streamed version of fit, see IPCAGenerator.fit_from_files. There is only one model, so it is fitted in this process.
+        '''
+        if checkpoint_dir is not None and not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        checkpoint_path = None if checkpoint_dir is None else f"{checkpoint_dir}/ipca_FDWFRL.pkl"
+        self.ipca = fit_ipca_streamed(self.ipca, filelist, ['plus', 'cross'], 'realimag', 'exp_unwrap', batch_size,
+                                      checkpoint_path, checkpoint_every)
+
     def project(self, strain):
         #pca = self.pca_dict[modename][part]
         #proj = pca.transform(strain)
         proj = np.dot(strain, self.ipca.components_.T)
         return proj 
+
+
+def load_templates(h5file, name, start, end):
+    '''
+    Complex templates [start:end] of name, from strains/{name} (data files) or waveform_polarizations/{name} (waveform files).
+    '''
+    if f'strains/{name}' in h5file:
+        return h5file[f'strains/{name}'][start:end]
+    group = h5file[f'waveform_polarizations/{name}']
+    return group['amplitude'][start:end] * np.exp(1j * group['phase'][start:end])
+
+def iterate_template_batches(filelist, names, batch_size):
+    '''
+    Yield dicts {name: [batch_size, Nfreq] complex templates} read across files. Only the last batch may be smaller.
+    '''
+    buffer = {name: [] for name in names}
+    nbuffer = 0
+    for filename in filelist:
+        with h5py.File(filename, 'r') as f:
+            if f'strains/{names[0]}' in f:
+                Nsample = len(f[f'strains/{names[0]}'])
+            else:
+                Nsample = len(f[f'waveform_polarizations/{names[0]}/amplitude'])
+            start = 0
+            while start < Nsample:
+                end = min(Nsample, start + batch_size - nbuffer)
+                for name in names:
+                    buffer[name].append(load_templates(f, name, start, end))
+                nbuffer += end - start
+                start = end
+                if nbuffer == batch_size:
+                    yield {name: np.concatenate(buffer[name]) for name in names}
+                    buffer = {name: [] for name in names}
+                    nbuffer = 0
+    if nbuffer > 0:
+        yield {name: np.concatenate(buffer[name]) for name in names}
+
+def get_template_part(h, part, decomposition):
+    '''
+    Arrays fed to partial_fit for one part of templates h, in the same way as IPCAGenerator.fit.
+    '''
+    if part == 'amplitude':
+        return [np.abs(h)]
+    elif part == 'phase':
+        if decomposition == 'exp_wrap':
+            return [np.angle(h)]
+        return [np.unwrap(np.angle(h))]
+    elif part == 'realimag':
+        return [np.real(h), np.imag(h)]
+    else:
+        raise ValueError(f"Unknown part {part}!")
+
+def fit_ipca_streamed(ipca, filelist, names, part, decomposition, batch_size, checkpoint_path=None, checkpoint_every=10):
+    '''
+    partial_fit ipca on batches of templates of names. Runs in worker processes of IPCAGenerator.fit_from_files.
+    The model and the number of batches fitted are pickled to checkpoint_path every checkpoint_every batches, 
+    if checkpoint_path exists the fit continues after the batches already fitted.
+    '''
+    nbatch_done = 0
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'rb') as f:
+            checkpoint = pickle.load(f)
+        if checkpoint['done']:
+            return checkpoint['ipca']
+        ipca = checkpoint['ipca']
+        nbatch_done = checkpoint['nbatch']
+        print(f"Resuming {names} {part} from batch {nbatch_done}")
+
+    nbatch = 0
+    for batch in iterate_template_batches(filelist, names, batch_size):
+        nbatch += 1
+        if nbatch <= nbatch_done:
+            continue
+        if len(batch[names[0]]) < ipca.n_components:
+            print("Last batch has less than n_components samples, skipped.")
+            continue
+        for name in names:
+            for x in get_template_part(batch[name], part, decomposition):
+                ipca.partial_fit(x)
+        if checkpoint_path is not None and nbatch % checkpoint_every == 0:
+            save_ipca_checkpoint(ipca, nbatch, False, checkpoint_path)
+
+    if checkpoint_path is not None:
+        save_ipca_checkpoint(ipca, nbatch, True, checkpoint_path)
+    return ipca
+
+def save_ipca_checkpoint(ipca, nbatch, done, checkpoint_path):
+    tmpname = checkpoint_path + '.tmp'
+    with open(tmpname, 'wb') as f:
+        pickle.dump({'ipca': ipca, 'nbatch': nbatch, 'done': done}, f)
+    os.replace(tmpname, checkpoint_path)
@@ -10,6 +10,8 @@ import zuko
 from collections import OrderedDict, namedtuple
 from itertools import product
 import scipy
+import threading
+import queue
 
 import pandas as pd
 from .embedding.conv import EmbeddingConv1D, EmbeddingConv2D, MyEmbeddingConv2D,MyEmbeddingConv1D, EmbeddingResConv1DMLP, EmbeddingConv1DMLP
@@ -430,6 +432,94 @@ def sample_glasflow_v3(flow, embedding, resnet, dataset, detector_names, ipca_ge
 
 
 
+class DataEchoLoader():
+    '''
+    Data echoing (Choi et al. 2019) between a loader of (theta, x) batches and the training loop, for when making data is slower 
+    than a training step. A background thread fills a queue from loader, batches go into a shuffle buffer of buffer_size batches, 
+    and each step returns a random batch of the buffer. A batch is returned at most echo times, and is dropped earlier 
+    (after being used at least once) when newer batches need the space, so the echo factor goes down when data generation keeps up.
+
+    add_noise: add fresh white noise (N(0,1) for real and imaginary parts in whitened SVD space) every time a batch is returned.
+    The dataset should then make noiseless data (add_noise=False).
+    stats(): batches loaded and returned in the last pass, and their ratio (the achieved echo factor).
+    '''
+    def __init__(self, loader, echo=2, buffer_size=8, add_noise=False, seed=None):
+        self.loader = loader
+        self.echo = echo
+        self.buffer_size = buffer_size
+        self.add_noise = add_noise
+        self.rng = np.random.default_rng(seed)
+        self.nloaded = 0
+        self.nreturned = 0
+
+    def stats(self):
+        return {'loaded': self.nloaded, 'returned': self.nreturned, 
+                'echo_factor': self.nreturned / self.nloaded if self.nloaded else 0.}
+
+    def produce(self, q, stop):
+        try:
+            for batch in self.loader:
+                while not stop.is_set():
+                    try:
+                        q.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception as e:
+            q.put(e)
+        q.put(None)
+
+    def __iter__(self):
+        self.nloaded = 0
+        self.nreturned = 0
+        q = queue.Queue(maxsize=self.buffer_size)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.produce, args=(q, stop), daemon=True)
+        thread.start()
+        buffer = []  # [theta, x, times returned]
+        finished = False
+        try:
+            while True:
+                # take new batches while there is room, or room can be made by dropping a used batch
+                while not finished:
+                    used = [i for i, item in enumerate(buffer) if item[2]>0]
+                    if len(buffer) >= self.buffer_size and not used:
+                        break
+                    try:
+                        batch = q.get(block=len(buffer)==0)
+                    except queue.Empty:
+                        break
+                    if batch is None:
+                        finished = True
+                        break
+                    if isinstance(batch, Exception):
+                        raise batch
+                    if len(buffer) >= self.buffer_size:
+                        # the most used batch makes room
+                        buffer.pop(max(used, key=lambda i: buffer[i][2]))
+                    buffer.append([batch[0], batch[1], 0])
+                    self.nloaded += 1
+                if not buffer:
+                    return
+
+                i = self.rng.integers(len(buffer))
+                theta, x, _ = buffer[i]
+                buffer[i][2] += 1
+                if buffer[i][2] >= self.echo:
+                    buffer.pop(i)
+                if self.add_noise:
+                    if x.is_complex():
+                        x = x + torch.view_as_complex(torch.randn(x.shape + (2,), dtype=x.real.dtype, device=x.device))
+                    else:
+                        x = x + torch.randn_like(x)
+                self.nreturned += 1
+                yield theta, x
+        finally:
+            stop.set()
+
+
 def train_GlasNSFWarpper(model, optimizer, dataloader, detector_names=None, ipca_gen=None, device='cpu',downsample_rate=1, minibatch_size=0):
     model.train()
     loss_list = []
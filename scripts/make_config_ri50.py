@@ -61,8 +61,26 @@ if __name__ == "__main__":
     #config_dict['training_parameters']['Nsample'] = 1000000
     #config_dict['training_parameters']['Nvalid'] = 1000
     config_dict['training_parameters']['batch_size_train'] = 16384
-    config_dict['training_parameters']['minibatch_size_train'] = 128
     config_dict['training_parameters']['batch_size_valid'] = 500
+    config_dict['training_parameters']['num_workers'] = 0
+    # lazy_load: read waveform rows when used, the cache then holds open files (wf_cache_files) and no data, wf_cache_bytes
+    # only bounds the memory of whole files loaded with lazy_load=False
+    config_dict['training_parameters']['lazy_load'] = True
+    config_dict['training_parameters']['wf_cache_files'] = 16
+    config_dict['training_parameters']['wf_cache_bytes'] = 0
+    config_dict['training_parameters']['generation_memory'] = 2**30  # bytes of simulation buffers per training batch
+    config_dict['training_parameters']['shuffle_window'] = 8
+    config_dict['training_parameters']['multiplicity'] = 1
+    config_dict['training_parameters']['data_echo'] = 1
+    config_dict['training_parameters']['data_echo_buffer_size'] = 8
+    config_dict['training_parameters']['data_echo_renoise'] = True
+    config_dict['training_parameters']['svd_timeshift'] = False
+    config_dict['training_parameters']['svd_timeshift_tolerance'] = 1e-5
+    config_dict['training_parameters']['svd_timeshift_order'] = None  # chosen for the smallest table
+    config_dict['training_parameters']['svd_timeshift_max_bytes'] = 2**34
+    config_dict['training_parameters']['svd_timeshift_cache_dir'] = f'{ckpt_dir}/svd_timeshift'
+    config_dict['training_parameters']['frozen_valid_dir'] = f'{ckpt_dir}/frozen_valid'
+    config_dict['training_parameters']['frozen_valid_seed'] = 0
     config_dict['training_parameters']['batch_size_test'] = 10
     config_dict['training_parameters']['lr'] = 5e-4
     config_dict['training_parameters']['weight_decay'] = 1e-5
@@ -82,6 +100,7 @@ if __name__ == "__main__":
     config_dict['model_parameters'] = {}
     config_dict['model_parameters']['Vhfile'] = '/home/qian.hu/mlpe/river/test/outputs/Vh_50Hz1024Hz32s.pickle'
     config_dict['model_parameters']['Nbasis'] = 512
+    config_dict['model_parameters']['basis_cache_dir'] = f'{ckpt_dir}/basis_cache'
 
     # Embedding - projection
     config_dict['model_parameters']['embedding'] = {}
@@ -17,7 +17,8 @@ from torch import nn
 
 import river.data
 from river.data.datagenerator import DataGeneratorBilbyFD
-from river.data.dataset import DatasetSVDStrainFDFromSVDWFonGPU, DatasetSVDStrainFDFromSVDWFonGPUBatch
+from river.data.svdops import FusedStrainSimulator
+from river.data.dataset import DatasetSVDStrainFDFromSVDWFonGPU, DatasetSVDStrainFDFromSVDWFonGPUBatch, DatasetSVDStrainFDFromSVDWFonGPUIterable, DatasetFrozen, worker_init_fn
 #import river.data.utils as datautils
 from river.data.utils import *
 
@@ -94,24 +95,54 @@ def main():
     
     Vhfile = config_model['Vhfile']
     Nbasis = config_model['Nbasis']
+    # pickled Vh converted to memory-mappable .npy, and whitened bases, cached here
+    basis_cache_dir = config_model.get('basis_cache_dir', None)
     batch_size_train = config_training['batch_size_train']
-    minibatch_size_train = config_training['minibatch_size_train']
     batch_size_valid = config_training['batch_size_valid']
-
-
-    dataset_train = DatasetSVDStrainFDFromSVDWFonGPUBatch(train_filenames, PARAMETER_NAMES_CONTEXT_PRECESSINGBNS_BILBY, data_generator,
-                                     Nbasis=Nbasis, Vhfile=Vhfile, device=device, minibatch_size=minibatch_size_train, fix_extrinsic=True)
+    num_workers = config_training.get('num_workers', 0)
+    # data echoing: reuse training batches up to data_echo times while new ones are made, with fresh noise if data_echo_renoise
+    data_echo = config_training.get('data_echo', 1)
+    data_echo_renoise = config_training.get('data_echo_renoise', False) and data_echo>1
+
+
+    # whole batches are simulated generation_chunk samples at a time, so that the buffers fit in generation_memory bytes
+    generation_chunk = FusedStrainSimulator.get_chunk_size(len(detector_names), len(data_generator.frequency_array_masked),
+                                                           config_training.get('generation_memory', 2**30))
+    logger.info(f'generation_chunk: {generation_chunk}')
+
+    # yields whole training batches, no collation
+    dataset_train = DatasetSVDStrainFDFromSVDWFonGPUIterable(train_filenames, PARAMETER_NAMES_CONTEXT_PRECESSINGBNS_BILBY, data_generator,
+                                     Nbasis=Nbasis, Vhfile=Vhfile, device=device, batch_size=batch_size_train, fix_extrinsic=True,
+                                     shuffle_window=config_training.get('shuffle_window', None),
+                                     multiplicity=config_training.get('multiplicity', 1), interleave_multiplicity=True,
+                                     add_noise=not data_echo_renoise, generation_chunk=generation_chunk,
+                                     lazy_load=config_training.get('lazy_load', True),
+                                     wf_cache_files=config_training.get('wf_cache_files', 16),
+                                     wf_cache_bytes=config_training.get('wf_cache_bytes', 0),
+                                     svd_timeshift=config_training.get('svd_timeshift', False),
+                                     svd_timeshift_tolerance=config_training.get('svd_timeshift_tolerance', 1e-5),
+                                     svd_timeshift_order=config_training.get('svd_timeshift_order', None),
+                                     svd_timeshift_max_bytes=config_training.get('svd_timeshift_max_bytes', 2**34),
+                                     svd_timeshift_cache_dir=config_training.get('svd_timeshift_cache_dir', None),
+                                     basis_cache_dir=basis_cache_dir)
     dataset_valid = DatasetSVDStrainFDFromSVDWFonGPU(valid_filenames, PARAMETER_NAMES_CONTEXT_PRECESSINGBNS_BILBY, data_generator,
-                                     Nbasis=Nbasis, Vhfile=Vhfile, device=device, fix_extrinsic=True)
+                                     Nbasis=Nbasis, Vhfile=Vhfile, device=device, fix_extrinsic=True, basis_cache_dir=basis_cache_dir)
+    # simulate the validation set once and reuse it in every epoch (and run)
+    frozen_valid_dir = config_training.get('frozen_valid_dir', None)
+    if frozen_valid_dir is not None:
+        dataset_valid = DatasetFrozen(dataset_valid, frozen_valid_dir, seed=config_training.get('frozen_valid_seed', 0), device=device)
 
     
 
-    Nsample = len(dataset_train)*minibatch_size_train
+    Nsample = dataset_train.Nsample
     Nvalid = len(dataset_valid)
     logger.info(f'Nsample: {Nsample}, Nvalid: {Nvalid}.')
     logger.info(f'batch_size_train: {batch_size_train}, batch_size_valid: {batch_size_valid}')
 
-    train_loader = DataLoader(dataset_train, batch_size=batch_size_train // minibatch_size_train, shuffle=False)
+    train_loader = DataLoader(dataset_train, batch_size=None, num_workers=num_workers, worker_init_fn=worker_init_fn)
+    if data_echo>1:
+        train_loader = DataEchoLoader(train_loader, echo=data_echo, buffer_size=config_training.get('data_echo_buffer_size', 8),
+                                      add_noise=data_echo_renoise)
     valid_loader = DataLoader(dataset_valid, batch_size=batch_size_valid, shuffle=False)
 
 
@@ -176,7 +207,8 @@ def main():
 
     for epoch in range(start_epoch, max_epoch):    
         
-        train_loss, train_loss_std = train_GlasNSFWarpper(model, optimizer, train_loader, device=device, minibatch_size=minibatch_size_train)
+        dataset_train.set_epoch(epoch)
+        train_loss, train_loss_std = train_GlasNSFWarpper(model, optimizer, train_loader, device=device)
         valid_loss, valid_loss_std = eval_GlasNSFWarpper(model, valid_loader, device=device)
 
 
@@ -184,6 +216,13 @@ def main():
         valid_losses.append(valid_loss)
 
         logger.info(f'epoch {epoch}, train loss = {train_loss}±{train_loss_std}, valid loss = {valid_loss}±{valid_loss_std}')
+        if num_workers == 0:
+            # with workers these are in the workers' copies of the dataset, not in this one
+            logger.info(f'epoch {epoch}, I/O wait of training data: {dataset_train.prefetcher.io_wait_time:.2f}s, '
+                        f'waveform cache hit rate: {dataset_train.wf_cache.stats()["hit_rate"]:.3f}')
+            dataset_train.wf_cache.reset_stats()
+        if data_echo>1:
+            logger.info(f'epoch {epoch}, data echo: {train_loader.stats()}')
 
         if valid_loss==min(valid_losses):
             best_epoch = epoch
@@ -217,9 +256,6 @@ def main():
             logger.info(f'Loaded model states from {ckpt_path}, and best epoch {best_epoch}. Going from there with a smaller lr.')
             lr_updated_epoch = epoch
             '''
-        dataset_train.shuffle_indexinfile()
-        dataset_train.shuffle_wflist()
-        train_loader = DataLoader(dataset_train, batch_size=batch_size_train // minibatch_size_train, shuffle=False)
 if __name__ == "__main__":
     main()
 